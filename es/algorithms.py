@@ -1,7 +1,7 @@
 import collections
 import copy
-import csv
 import datetime
+import io
 import math
 import os
 import pickle
@@ -10,25 +10,63 @@ import pprint
 import queue
 import time
 from abc import ABCMeta, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
 from functools import partial
 from itertools import zip_longest
 
 import gym
-import IPython
 import numpy as np
 import pandas as pd
 import torch
 import torch.functional as F
 import torch.multiprocessing as mp
-from torch.autograd import Variable
+from torch.func import functional_call, jacrev
+
+try:
+    from numba import njit
+except ImportError:
+    def njit(*args, **kwargs):
+        # Run the functions uncompiled if numba is not installed
+        return lambda f: f
 
 from context import utils
-from utils.misc import get_inputs_from_dict, to_numeric, isint
-from utils.plotting import plot_stats
-from utils.progress import PoolProgress
+from utils.misc import get_inputs_from_dict, isint
+from utils.progress import ProgressBar
 from utils.torchutils import summarize_model
 
 
+@njit(cache=True)
+def _unperturbed_rank(returns, unperturbed_return):
+    rank = 1
+    for r in returns:
+        if r > unperturbed_return:
+            rank += 1
+    return rank
+
+
+@njit(cache=True)
+def _fitness_shaping(returns):
+    n = returns.shape[0]
+    ranks = np.empty(n, dtype=np.intp)
+    ranks[np.argsort(-returns)] = np.arange(n)
+    u = np.maximum(0, np.log(n / 2 + 1) - np.log(ranks + 1))
+    return u / np.sum(u) - 1 / n
+
+
+# State of an evaluation worker process set by `_init_worker` and `Algorithm._copy_model`
+_worker = {}
+
+
+def _init_worker(env, val_env):
+    """Initializes a worker process of the evaluation pool.
+
+    The environments are sent to each worker once when the pool is created instead of
+    with every task. The algorithm gets them back when unpickled in the worker.
+    """
+    _worker['env'] = env
+    _worker['val_env'] = val_env
+
+
 class Algorithm(object):
     """Abstract class for variational algorithms
 
@@ -46,11 +84,13 @@ class Algorithm(object):
         chkpt_int (int): The interval in seconds between checkpoint saves. If chkpt_int<=0, a checkpoint is made at every generation.
         cuda (bool): Boolean to denote whether or not to use CUDA
         silent (bool): Boolean to denote if executing should be silent (no terminal printing)
+        debug (bool): Boolean to denote whether to check that perturbations, gradients and sensitivities are finite
+        batch_eval_fun (function): If given, evaluates all perturbations at once in a forward pass vectorized over the perturbed parameters instead of using `eval_fun`. The model must not have buffers (e.g. batch normalization)
     """
 
     __metaclass__ = ABCMeta
 
-    def __init__(self, model, env, optimizer, lr_scheduler, eval_fun, perturbations, batch_size, max_generations, safe_mutation, no_antithetic, common_random_numbers=False, adaptation_sampling=True, forced_refresh=0.01, val_env=None, val_every=25, workers=mp.cpu_count(), chkpt_dir=None, chkpt_int=600, track_parallel=False, cuda=False, silent=False):
+    def __init__(self, model, env, optimizer, lr_scheduler, eval_fun, perturbations, batch_size, max_generations, safe_mutation, no_antithetic, common_random_numbers=False, adaptation_sampling=True, forced_refresh=0.01, val_env=None, val_every=25, workers=mp.cpu_count(), chkpt_dir=None, chkpt_int=600, track_parallel=False, cuda=False, silent=False, debug=False, batch_eval_fun=None):
         self.algorithm = self.__class__.__name__
         # Algorithmic attributes
         self.model = model
@@ -59,6 +99,7 @@ class Algorithm(object):
         self.optimizer = optimizer
         self.lr_scheduler = lr_scheduler
         self.eval_fun = eval_fun
+        self.batch_eval_fun = batch_eval_fun
         self.safe_mutation = safe_mutation
         self.no_antithetic = no_antithetic
         self.adaptation_sampling = adaptation_sampling
@@ -73,6 +114,11 @@ class Algorithm(object):
         self.track_parallel = track_parallel
         self.cuda = cuda
         self.silent = silent
+        self.debug = debug
+        if self.cuda:
+            # The model is kept on the GPU throughout training
+            self.model.cuda()
+        assert batch_eval_fun is None or not list(self.model.buffers()), 'Batch evaluation requires a model without buffers'
         # Checkpoint attributes
         self.chkpt_dir = chkpt_dir
         self.chkpt_int = chkpt_int
@@ -91,17 +137,55 @@ class Algorithm(object):
             # self.sens_inputs[0,...] = torch.from_numpy(s)
             # for i in range(999):
             #     self.sens_inputs[i+1,...] = torch.from_numpy(self.env.observation_space.sample())
-        elif type(self.env) is torch.utils.data.DataLoader:
+        elif hasattr(self.env, 'dataset'):
+            # Data loader of a supervised problem
             self.sens_inputs = next(iter(self.env))[0]
         if self.safe_mutation is None:
             self.sens_inputs = self.sens_inputs[0:2] # self.sens_inputs[0].view(1, *self.sens_inputs.size()[1:])
         # Attributes to exclude from the state dictionary
-        self.exclude_from_state_dict = {'env', 'optimizer', 'lr_scheduler', 'model', 'stats', 'sens_inputs'}
+        self.exclude_from_state_dict = {'env', 'optimizer', 'lr_scheduler', 'model', 'stats', 'sens_inputs', '_perturbation_cache', '_perturbation_rows', 'debug', 'batch_eval_fun', '_worker_state'}
+        # Cache of the perturbations of the current generation
+        self._perturbation_cache = None
+        self._perturbation_rows = {}
+        # CPU copies of the model and sensitivities sent to the workers if the model is on the GPU
+        self._worker_state = None
         # Initialize dict for saving statistics
         self._base_stat_keys = {'generations', 'walltimes', 'workertimes', 'unp_rank', 'n_reused', 'n_rejected', 'grad_norm', 'param_norm'}
         self.stats = {key: [] for key in self._base_stat_keys}
         self._training_start_time = None
 
+    def __getstate__(self):
+        """Gets the state to pickle when sending the algorithm to the evaluation workers.
+
+        The environments are already in the workers and the optimizer, learning rate
+        scheduler, statistics and sensitivity inputs are only used in the main process.
+        """
+        state = self.__dict__.copy()
+        for k in ['env', 'val_env', 'optimizer', 'lr_scheduler', 'stats', 'sens_inputs']:
+            state.pop(k, None)
+        state.update(state.pop('_worker_state', None) or {})
+        return state
+
+    def _share_with_workers(self):
+        """Shares the parent model and its sensitivities with the evaluation workers.
+
+        The workers evaluate on the CPU. If the model is on the GPU it stays there and a copy 
+        in shared CPU memory is updated in place once per generation and sent instead.
+        """
+        if not self.cuda:
+            self.model.share_memory_()
+            return
+        if self._worker_state is None:
+            self._worker_state = {'model': copy.deepcopy(self.model).cpu().share_memory_()}
+        else:
+            self._worker_state['model'].load_state_dict(self.model.state_dict())
+        self._worker_state['sensitivities'] = [s.cpu() if s is not None else None for s in self.sensitivities]
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.env = _worker.get('env')
+        self.val_env = _worker.get('val_env')
+
     @abstractmethod
     def train(self):
         pass
@@ -139,6 +223,14 @@ class Algorithm(object):
         if 'label' in parameter_group:
             return list(filter(lambda group: group['label'] == parameter_group['label'], self.optimizer.param_groups))[0]
 
+    def _check_finite(self, tensor):
+        """Asserts that all values of a tensor are finite when debugging.
+
+        The check is skipped otherwise since it synchronizes with the device on every call.
+        """
+        if self.debug:
+            assert torch.isfinite(tensor).all(), 'Encountered non-finite values'
+
     @staticmethod
     def unperturbed_rank(returns, unperturbed_return):
         """Computes the rank of the unperturbed model among the perturbations.
@@ -150,7 +242,7 @@ class Algorithm(object):
         Returns:
             int: Rank of the unperturbed model among the perturbations
         """      
-        return (returns > unperturbed_return).sum() + 1
+        return _unperturbed_rank(np.asarray(returns, dtype=np.float64), float(unperturbed_return))
 
     @staticmethod
     def fitness_shaping(returns):
@@ -166,12 +258,7 @@ class Algorithm(object):
             np.array: Shaped returns
         """
         assert type(returns) == np.ndarray
-        n = len(returns)
-        sorted_indices = np.argsort(-returns)
-        u = np.zeros(n)
-        for k in range(n):
-            u[sorted_indices[k]] = np.max([0, np.log(n / 2 + 1) - np.log(k + 1)])
-        return u / np.sum(u) - 1 / n
+        return _fitness_shaping(returns.astype(np.float64))
 
     @staticmethod
     def fitness_normalization(returns, unperturbed_return):
@@ -180,18 +267,21 @@ class Algorithm(object):
             returns /= returns.std()
         else:
             assert (returns == returns).all()
+        import IPython
         IPython.embed()
         returns /= returns.sum()
         assert returns.sum() == 1.0
         return returns
     
     @staticmethod
-    def get_perturbation(size, sensitivities=None, cuda=False):
+    def get_perturbation(size, sensitivities=None, cuda=False, generator=None):
         """Draws a perturbation tensor of dimension `size` from a standard normal.
 
         If `sensitivities is not None`, then the perturbation is scaled by these.
         If sensitivities are given and `sensitivities.size() == size[1:]` then the `size[0]` is 
         intepreted as a number of samples each of which is to be scaled by the given sensitivities.
+        If a `generator` is given, the perturbation is drawn from it on its device. Otherwise the
+        global generator of the CPU or, if `cuda`, the GPU is used.
         """
         if type(size) in [tuple, list]:
             size = torch.Size(size)
@@ -204,21 +294,21 @@ class Algorithm(object):
         if sensitivities is not None and sensitivities.size() == size[1:]:
             samples = size[0]
         assert sensitivities is None or sensitivities.size() == size or sensitivities.size() == size[1:], "Sensitivities must match size of perturbation"
-        if cuda:
-            eps = torch.cuda.FloatTensor(size)
+        if generator is not None:
+            device = generator.device
         else:
-            eps = torch.FloatTensor(size)
-        eps.normal_(mean=0, std=1)
+            device = 'cuda' if cuda else 'cpu'
+        eps = torch.randn(size, generator=generator, device=device)
         if sensitivities is not None:
             if sensitivities.size() == size[1:]:
                 for s in range(samples):
-                    eps[s, ...] /= sensitivities      # Scale by sensitivities
+                    eps[s, ...].div_(sensitivities)   # Scale by sensitivities
                     if eps.numel() > 1:
-                        eps /= eps.std()              # Rescale to unit variance
+                        eps.div_(eps.std())           # Rescale to unit variance
             else:
-                eps /= sensitivities     # Scale by sensitivities
+                eps.div_(sensitivities)  # Scale by sensitivities
                 if eps.numel() > 1:
-                    eps /= eps.std()     # Rescale to unit variance
+                    eps.div_(eps.std())  # Rescale to unit variance
         return eps
 
     @staticmethod
@@ -238,6 +328,103 @@ class Algorithm(object):
             eps *= std
         return eps
 
+    def _seeded_generator(self, seed):
+        """Returns a random number generator on the device of the model seeded by the absolute value of `seed`.
+        """
+        generator = torch.Generator(device=next(self.model.parameters()).device)
+        generator.manual_seed(abs(int(seed)))
+        return generator
+
+    def _draw_perturbation(self, seed, out=None):
+        """Draws the perturbation of a seed as a single flat tensor on the device of the model.
+
+        The noise of all parameters is drawn with one call to the seeded generator and the part of 
+        each parameter is then scaled by its sensitivities and rescaled to unit variance.
+
+        Args:
+            seed (int): The seed of the perturbation. Its sign is not applied.
+            out (torch.Tensor, optional): Defaults to None. Flat tensor on the device of the model to draw into
+        """
+        generator = self._seeded_generator(seed)
+        eps = torch.randn(self.model.count_parameters(only_trainable=True), generator=generator, device=generator.device, out=out)
+        i = 0
+        for p, sens in zip_longest(self.model.parameters(), self.sensitivities):
+            j = i + p.numel()
+            if sens is not None:
+                eps[i:j].div_(sens.reshape(-1))  # Scale by sensitivities
+                if j - i > 1:
+                    eps[i:j].div_(eps[i:j].std())  # Rescale to unit variance
+            i = j
+        return eps
+
+    def generate_perturbations(self, seeds):
+        """Draws the perturbations of a generation once and caches them.
+
+        The perturbations are stored as rows of a single matrix with one row per unique absolute seed
+        such that antithetic pairs share a row. The matrix is shared with the workers when the algorithm
+        is sent to them, so neither the perturbed models nor the gradient computation regenerate the noise.
+        The noise is drawn on the device of the model and the matrix is moved to CPU memory in one transfer.
+
+        Args:
+            seeds (torch.LongTensor): The seeds of the generation (including any reused seeds)
+        """
+        abs_seeds = list(collections.OrderedDict.fromkeys(abs(int(s)) for s in seeds))
+        self._perturbation_rows = {s: row for row, s in enumerate(abs_seeds)}
+        cache = torch.empty(len(abs_seeds), self.model.count_parameters(only_trainable=True), device=next(self.model.parameters()).device)
+        for s, eps in zip(abs_seeds, cache):
+            self._draw_perturbation(s, out=eps)
+        self._perturbation_cache = cache.cpu()
+
+    def get_cached_perturbation(self, seed):
+        """Returns the perturbation of a seed as a list of tensors matching the model parameters.
+
+        The antithetic sign of the seed is not applied. Seeds that are not in the cache of the
+        current generation have their perturbation regenerated.
+        """
+        row = self._perturbation_rows.get(abs(int(seed)))
+        if row is not None:
+            return self._vec2modelrepr(self._perturbation_cache[row].to(next(self.model.parameters()).device))
+        return self._vec2modelrepr(self._draw_perturbation(seed))
+
+    def _perturbation_returns(self, returns, seeds):
+        """Sums the returns of the seeds onto the rows of the perturbation cache.
+
+        The perturbations are (re)generated if any of the seeds is not in the cache.
+
+        Args:
+            returns (np.array): The (shaped) returns of the seeds
+            seeds (torch.LongTensor): The seeds of the returns
+        
+        Returns:
+            tuple: The returns multiplied by the antithetic sign and the unsigned returns, summed per row of the cache
+        """
+        if any(abs(int(s)) not in self._perturbation_rows for s in seeds):
+            self.generate_perturbations(seeds)
+        rows = torch.LongTensor([self._perturbation_rows[abs(int(s))] for s in seeds])
+        returns = torch.from_numpy(np.asarray(returns, dtype=np.float32))
+        signs = seeds.float().sign()
+        signed_returns = torch.zeros(len(self._perturbation_rows)).index_add_(0, rows, signs * returns)
+        unsigned_returns = torch.zeros(len(self._perturbation_rows)).index_add_(0, rows, returns)
+        return signed_returns, unsigned_returns
+
+    def _copy_model(self):
+        """Returns a copy of the model with the current parameters.
+
+        A single copy is allocated per process and reused for all the perturbations
+        evaluated in it instead of instantiating a new model for every perturbation.
+        If the model is compiled, the copy is compiled once when it is allocated.
+        """
+        model = _worker.get('model')
+        if type(model) is not type(self.model):
+            model = copy.deepcopy(self.model)
+            if getattr(model, '_compile_mode', None) is not None:
+                model.compile_forward(model._compile_mode)
+            _worker['model'] = model
+        else:
+            model.load_state_dict(self.model.state_dict())
+        model.zero_grad()
+        return model
+
     def _vec2modelrepr(self, vec, only_trainable=True, yield_generator=True):
         """Converts a 1xN Tensor into a list of Tensors, each matching the 
         dimension of the corresponding parameter in the model.
@@ -269,7 +456,7 @@ class Algorithm(object):
             i = 0
             for p in modelrepr:
                 j = i + p.numel()
-                vec[i:j] = p.data.view(-1) if type(p) is Variable else p.view(-1)
+                vec[i:j] = p.data.reshape(-1)
                 i = j
             return vec
 
@@ -292,54 +479,42 @@ class Algorithm(object):
         # Forward pass on input batch
         if inputs is None:
             inputs = self.sens_inputs
-        if type(inputs) is not Variable:
-            inputs = Variable(inputs)
         if self.cuda:
             inputs = inputs.cuda()
-            self.model.cuda()
         if self.safe_mutation is None:
             # Dummy backprop to initialize gradients, then return
             output = self.model(inputs)
-            if self.cuda:
-                t = torch.cuda.FloatTensor(1, output.data.size()[1]).fill_(0)
-            else:
-                t = torch.zeros(1, output.data.size()[1])
-            t[0, 0] = 1
+            t = torch.zeros_like(output[0])
+            t[0] = 1
             output[0].backward(t)
             self.model.zero_grad()
             return
-        outputs = self.model(inputs)
-        batch_size = outputs.data.size()[0]
-        n_outputs = outputs.data.size()[1]
-        if self.cuda:
-            t = torch.cuda.FloatTensor(batch_size, n_outputs).fill_(0)
-        else:
-            t = torch.zeros(batch_size, n_outputs)
         # Compute sensitivities using specified method
         if self.safe_mutation == 'ABS':
-            sensitivities = self._compute_sensitivities_abs(outputs, t)
+            sensitivities = self._compute_sensitivities_abs(inputs)
         elif self.safe_mutation == 'SUM':
-            sensitivities = self._compute_sensitivities_sum(outputs, t)
+            sensitivities = self._compute_sensitivities_sum(inputs)
         elif self.safe_mutation == 'SO':
             raise NotImplementedError('The second order safe mutation (SM-SO) is not yet implemented')
         elif self.safe_mutation == 'R':
             raise NotImplementedError('The SM-R safe mutation is not yet implemented')
         else:
             raise ValueError('The type ''{:s}'' of safe mutations is unrecognized'.format(self.safe_mutation))
-        # Remove infs
-        if do_numerical:
-            overflow = False
-            for pid in range(len(sensitivities)):
-                sensitivities[pid][np.isinf(sensitivities[pid])] = 1
-                overflow = overflow or np.isinf(sensitivities[pid]).any()
-            if overflow:
-                print('| Encountered numerical overflow in sensitivities', end='')
+        # Remove infs and find maximal sensitivity across all layers in a single pass
+        overflow = False
+        m = 0
+        for sens in sensitivities:
+            if do_numerical:
+                infs = torch.isinf(sens)
+                if infs.any():
+                    overflow = True
+                    sens.masked_fill_(infs, 1)
+            if do_normalize:
+                m = max(m, sens.max().item())
+        if overflow:
+            print('| Encountered numerical overflow in sensitivities', end='')
         # Normalize
         if do_normalize:
-            # Find maximal sensitivity across all layers
-            m = 0
-            for pid in range(len(sensitivities)):
-                m = np.max([m, sensitivities[pid].max()])
             if m == 0:
                 print(' | All sensitivities were zero.', end='')
                 for pid in range(len(sensitivities)):
@@ -347,17 +522,27 @@ class Algorithm(object):
                 self.sensitivities = sensitivities
                 return
             else:
-                # Divide all layers by max (and clamp below and above)
-                for pid in range(len(sensitivities)):
-                    sensitivities[pid] /= m
-                    sensitivities[pid].clamp_(min=1e-2, max=1)
+                # Divide all layers by max (and clamp below and above) in place
+                for sens in sensitivities:
+                    sens.div_(m).clamp_(min=1e-2, max=1)
         # Set sensitivities and assert their values
         for sens in sensitivities:
-            assert not np.isnan(sens).any()
-            assert not np.isinf(sens).any()
+            self._check_finite(sens)
         self.sensitivities = sensitivities
 
-    def _compute_sensitivities_abs(self, outputs, t):
+    def _sensitivities_autocast(self):
+        """Returns a context in which the sensitivity forward pass runs in bfloat16 if on the GPU.
+
+        The parameters and thereby their gradients stay in float32 so the sensitivities are accumulated in full precision.
+        """
+        return torch.autocast(device_type='cuda', dtype=torch.bfloat16, enabled=self.cuda)
+
+    def _compute_sensitivities_abs(self, inputs):
+        with self._sensitivities_autocast():
+            outputs = self.model(inputs)
+        batch_size = outputs.data.size()[0]
+        n_outputs = outputs.data.size()[1]
+        t = torch.zeros(batch_size, n_outputs, dtype=outputs.dtype, device=outputs.device)
         # Backward pass for each output unit (and accumulate gradients)
         sensitivities = []
         for k in range(t.size()[1]):
@@ -377,31 +562,33 @@ class Algorithm(object):
                     sensitivities.append(sens)
                 else:
                     sensitivities[pid] += sens
-        for pid, _ in enumerate(sensitivities):
-            sensitivities[pid] = sensitivities[pid].sqrt()
+        for sens in sensitivities:
+            sens.sqrt_()
         return sensitivities
 
-    def _compute_sensitivities_sum(self, outputs, t):
-        sensitivities = []
-        # Backward pass for each output unit (and accumulate gradients)
-        for k in range(t.size()[1]):
-            self.model.zero_grad()
-            # Compute dy_t/dw on batch
-            # Sum over signed gradients
-            t.fill_(0)
-            t[:, k].fill_(1)
-            outputs.backward(t, retain_graph=True)
-            # Get computed sensitivities and sum into those of other output units
-            for pid, param in enumerate(self.model.parameters()):
-                sens = param.grad.data.clone()  # Clone to sum correctly
-                sens = sens.pow(2)
-                if k == 0:
-                    sensitivities.append(sens)
-                else:
-                    sensitivities[pid] += sens
-        for pid, _ in enumerate(sensitivities):
-            sensitivities[pid] = sensitivities[pid].sqrt()
-        return sensitivities
+    def _compute_sensitivities_sum(self, inputs):
+        # Jacobian of the batch summed outputs wrt. the parameters in a single vectorized backward pass.
+        # Each parameter's Jacobian has the output units along the first dimension.
+        def summed_outputs(parameters):
+            with self._sensitivities_autocast():
+                return functional_call(self.model, parameters, (inputs,)).sum(dim=0)
+        parameters = dict(self.model.named_parameters())
+        # Batch normalization in training mode updates its running statistics in place which is not allowed 
+        # within the Jacobian transform. These are updated by a separate forward pass and the Jacobian is 
+        # computed with the batch statistics only, as in the forward pass of the model in training mode.
+        batch_norms = [m for m in self.model.modules() if isinstance(m, torch.nn.modules.batchnorm._BatchNorm) and m.training and m.track_running_stats]
+        if batch_norms:
+            with torch.no_grad(), self._sensitivities_autocast():
+                self.model(inputs)
+        for m in batch_norms:
+            m.track_running_stats = False
+        try:
+            jacobian = jacrev(summed_outputs)(parameters)
+        finally:
+            for m in batch_norms:
+                m.track_running_stats = True
+        # Sum squared gradients over output units
+        return [jacobian[name].float().pow(2).sum(dim=0).sqrt() for name in parameters.keys()]
 
     def _compute_sensitivities_so(self, outputs, t):
         pass
@@ -413,12 +600,9 @@ class Algorithm(object):
         """Separable case
         """
         sign = np.sign(seed)
-        torch.manual_seed(abs(seed))
-        torch.cuda.manual_seed(abs(seed))
         sample = []
-        for p, w, s, sens in zip(self.model.parameters(), mean, sigma, self.sensitivities):
-            eps = sign * self.get_perturbation(p.size(), sensitivities=sens, cuda=self.cuda)
-            sample.append(w + s * eps)
+        for w, s, eps in zip(mean, sigma, self._vec2modelrepr(self._draw_perturbation(seed))):
+            sample.append(w + s * sign * eps)
         # print("Importance mixing")
         # print(type(seed))
         # print(type(sign))
@@ -549,6 +733,7 @@ class Algorithm(object):
         # Potential better weights (larger step)
         original_optimizer_state = copy.deepcopy(self.optimizer.state_dict())
         new_optimizer_state = copy.deepcopy(self.optimizer.state_dict())
+        import IPython
         IPython.embed()
         if update_ids == 0:
             # Get potential new mean
@@ -610,6 +795,7 @@ class Algorithm(object):
             weights = (np.array([1] * len(S1)), np.array([1] * len(S2)))
         w1 = weights[0]
         w2 = weights[1]
+        import IPython
         IPython.embed()
         ids_eq = S1 == S2
         ids_larger = S1 > S2
@@ -624,7 +810,7 @@ class Algorithm(object):
         """Print the initial message when training is started
         """
         # Get strings to print
-        env_name = self.env.spec.id if hasattr(self.env, 'spec') else self.env.dataset.root.split('/')[-1]
+        env_name = self.env.spec.id if hasattr(self.env, 'spec') else getattr(self.env, 'name', None) or self.env.dataset.root.split('/')[-1]
         safe_mutation = self.safe_mutation if self.safe_mutation is not None else 'None'
         # Build init string
         s = "=================== SYSTEM ====================\n"
@@ -704,21 +890,15 @@ class Algorithm(object):
         Raises:
             IOError: If the loading fails, an IOError exception is raised
         """
-        # Get stats
-        with open(os.path.join(chkpt_dir, 'stats.csv'), 'r') as csvfile:
-            reader = csv.DictReader(csvfile)
-            stats = {k: [to_numeric(v)] for k, v in next(reader).items()}
-            for record in reader:
-                for k, v in record.items():
-                    stats[k].append(to_numeric(v))
-            stats.pop('')
+        # Get stats as columns of arrays
+        stats = pd.read_csv(os.path.join(chkpt_dir, 'stats.csv'), index_col=0)
         # Load state dict files
         algorithm_file = 'state-dict-best-algorithm.pkl' if load_best else 'state-dict-algorithm.pkl'
         model_file = 'state-dict-best-model.pkl' if load_best else 'state-dict-model.pkl'
         optimizer_file = 'state-dict-best-optimizer.pkl' if load_best else 'state-dict-optimizer.pkl'
-        algorithm_state_dict = torch.load(os.path.join(chkpt_dir, algorithm_file))
-        model_state_dict = torch.load(os.path.join(chkpt_dir, model_file))
-        optimizer_state_dict = torch.load(os.path.join(chkpt_dir, optimizer_file))
+        algorithm_state_dict = self._deserialize(os.path.join(chkpt_dir, algorithm_file))
+        model_state_dict = self._deserialize(os.path.join(chkpt_dir, model_file))
+        optimizer_state_dict = self._deserialize(os.path.join(chkpt_dir, optimizer_file))
         # Load state dicts into objects
         if load_algorithm:
             # Load algorithm state
@@ -728,12 +908,12 @@ class Algorithm(object):
         self.chkpt_dir = chkpt_dir
         self.model.load_state_dict(model_state_dict)
         self.optimizer.load_state_dict(optimizer_state_dict)
-        self.lr_scheduler.last_epoch = stats['generations'][-1]
+        self.lr_scheduler.last_epoch = int(stats['generations'].values[-1])
         # Set constants
-        self._training_start_time = algorithm_state_dict['_training_start_time'] + (time.time() - (stats['walltimes'][-1] + algorithm_state_dict['_training_start_time']))
-        self._max_unp_return = np.max(stats['return_unp'])
+        self._training_start_time = algorithm_state_dict['_training_start_time'] + (time.time() - (stats['walltimes'].values[-1] + algorithm_state_dict['_training_start_time']))
+        self._max_unp_return = stats['return_unp'].values.max()
         # self._max_unp_return = m
-        for k in stats.keys(): self.stats[k] = []
+        for k in stats.columns: self.stats[k] = []
 
     def _load_added_parameters(self, stats, optimizer_state_dict):
         for p in optimizer_state_dict['param_groups']:
@@ -790,43 +970,84 @@ class Algorithm(object):
                 self.stats[k + '_unp'].append(unperturbed_out[k])
                 self.stats[k + '_val'].append(unperturbed_val_out[k])
 
-    def _dump_stats(self):
+    def _dump_stats(self, stats):
         # Store stats as csv file on drive such that self does not grow in size
         # https://stackoverflow.com/questions/23613426/write-dictionary-of-lists-to-a-csv-file
         csvfile_path = os.path.join(self.chkpt_dir, 'stats.csv')
-        df = pd.DataFrame(self.stats, index=self.stats['generations'])
+        df = pd.DataFrame(stats, index=stats['generations'])
         with open(csvfile_path, 'a') as csvfile:
             print_header = os.stat(csvfile_path).st_size == 0
             df.to_csv(csvfile, header=print_header)
-        for k in self.stats.keys(): self.stats[k] = []
 
-    def save_checkpoint(self, best_model_stdct=None, best_optimizer_stdct=None, best_algorithm_stdct=None):
+    @staticmethod
+    def _serialize(obj):
+        buffer = io.BytesIO()
+        torch.save(obj, buffer)
+        return buffer.getvalue()
+
+    @staticmethod
+    def _deserialize(file_path):
+        """Loads a serialized object memory mapped such that workers share the pages of the file.
+
+        Objects that cannot be loaded as plain tensors and containers, such as the algorithm state,
+        and checkpoints in the legacy format are loaded with the full unpickler.
+        """
+        try:
+            return torch.load(file_path, mmap=True, weights_only=True)
+        except (pickle.UnpicklingError, RuntimeError):
+            return torch.load(file_path, weights_only=False)
+
+    def _write_checkpoint(self, stats, files, plot=False):
+        """Writes the statistics and the serialized state dictionaries of a checkpoint and optionally plots the statistics.
+        """
+        self._dump_stats(stats)
+        for file_name, data in files.items():
+            with open(os.path.join(self.chkpt_dir, file_name), 'wb') as f:
+                f.write(data)
+        if plot:
+            # Imported here since matplotlib and seaborn are slow to import and only needed for plotting
+            from utils.plotting import plot_stats
+            plot_stats(os.path.join(self.chkpt_dir, 'stats.csv'), self.chkpt_dir)
+
+    def save_checkpoint(self, best_model_stdct=None, best_optimizer_stdct=None, best_algorithm_stdct=None, plot=False, executor=None):
         """
         Save a checkpoint of the algorithm.
         
         The checkpoint consists of `self.model` and `self.optimizer` in the latest and best versions along with 
         statistics in the `self.stats` dictionary.
 
+        The state is serialized before returning, so training can continue while an `executor`
+        writes the files to disk and plots the statistics.
+
         Args:
             best_model_stdct (dict, optional): Defaults to None. State dictionary of the checkpoint's best model
             best_optimizer_stdct (dict, optional): Defaults to None. State dictionary of the associated optimizer
             best_algorithm_stdct (dict, optional): Defaults to None. State dictionary of the associated algorithm
+            plot (bool, optional): Defaults to False. Plot the statistics after saving them
+            executor (concurrent.futures.Executor, optional): Defaults to None. Executor to write the checkpoint with. If None, it is written before returning.
+        
+        Returns:
+            concurrent.futures.Future: The job writing the checkpoint if an executor is given, otherwise None
         """
         if self.chkpt_dir is None:
             return
-        # Save stats
-        self._dump_stats()
-        # Save latest model and optimizer state
-        torch.save(self.state_dict(exclude=True), os.path.join(self.chkpt_dir, 'state-dict-algorithm.pkl'))
-        torch.save(self.model.state_dict(), os.path.join(self.chkpt_dir, 'state-dict-model.pkl'))
-        torch.save(self.optimizer.state_dict(), os.path.join(self.chkpt_dir, 'state-dict-optimizer.pkl'))
-        # Save best model
+        # Take the stats and serialize latest model and optimizer state
+        stats = self.stats
+        self.stats = {k: [] for k in stats.keys()}
+        files = {'state-dict-algorithm.pkl': self._serialize(self.state_dict(exclude=True)),
+                 'state-dict-model.pkl': self._serialize(self.model.state_dict()),
+                 'state-dict-optimizer.pkl': self._serialize(self.optimizer.state_dict())}
+        # The best model is the latest one so its serialization is reused
         if best_model_stdct is not None:
-            torch.save(self.state_dict(exclude=True), os.path.join(self.chkpt_dir, 'state-dict-best-algorithm.pkl'))
-            torch.save(self.model.state_dict(), os.path.join(self.chkpt_dir, 'state-dict-best-model.pkl'))
-            torch.save(self.optimizer.state_dict(), os.path.join(self.chkpt_dir, 'state-dict-best-optimizer.pkl'))
+            files['state-dict-best-algorithm.pkl'] = files['state-dict-algorithm.pkl']
+            files['state-dict-best-model.pkl'] = files['state-dict-model.pkl']
+            files['state-dict-best-optimizer.pkl'] = files['state-dict-optimizer.pkl']
         if not self.silent:
             print(' | checkpoint', end='')
+        if executor is None:
+            self._write_checkpoint(stats, files, plot=plot)
+            return None
+        return executor.submit(self._write_checkpoint, stats, files, plot=plot)
         # Currently, learning rate scheduler has no state_dict and cannot be saved. 
         # It can however be restored by setting lr_scheduler.last_epoch = last generation index since
         # this is the only property that has any effect on its functioning.
@@ -878,6 +1099,58 @@ class StochasticGradientEstimation(Algorithm):
         # env = copy.deepcopy(self.env)
         return self.eval_fun(model, self.env, seed, **kwargs)
 
+    @staticmethod
+    def _collect(results, n_results, pb=None, timeout=3600):
+        """Collects the outputs of the evaluations in the order in which they finish.
+
+        Args:
+            results (multiprocessing.pool.IMapIterator): Iterator over the outputs of the workers
+            n_results (int): Number of outputs to collect
+            pb (ProgressBar, optional): Defaults to None. Progress bar to update as outputs arrive
+            timeout (int, optional): Defaults to 3600. Seconds to wait for each output
+        
+        Returns:
+            list: The outputs
+        """
+        outputs = []
+        if pb is not None:
+            pb.end_value = n_results
+            pb.start()
+        for _ in range(n_results):
+            outputs.append(results.next(timeout=timeout))
+            if pb is not None: pb.progress(len(outputs))
+        if pb is not None: pb.end()
+        return outputs
+
+    def _perturbation_scale(self):
+        """Returns the standard deviation of the perturbations as a scalar or as a vector with one entry per parameter.
+        """
+        raise NotImplementedError('Batch evaluation is not supported by ' + self.algorithm)
+
+    def _eval_batched(self, seeds, **kwargs):
+        """Evaluates all perturbations at once with `batch_eval_fun`.
+
+        The perturbed parameters are built from the cached perturbations with one tensor
+        per model parameter and the perturbations stacked along the first dimension.
+        """
+        rows = torch.LongTensor([self._perturbation_rows[abs(int(s))] for s in seeds])
+        signs = seeds.float().sign().unsqueeze(1)
+        parent = torch.cat([p.data.reshape(-1) for p in self.model.parameters()])
+        perturbed = parent + (signs * self._perturbation_scale() * self._perturbation_cache[rows]).to(parent.device)
+        self._check_finite(perturbed)
+        parameters = {}
+        i = 0
+        for name, p in self.model.named_parameters():
+            j = i + p.numel()
+            parameters[name] = perturbed[:, i:j].view(-1, *p.size())
+            i = j
+        return self.batch_eval_fun(self.model, parameters, self.env, seeds.tolist(), **kwargs)
+
+    def _eval_unperturbed(self, validate=False, **kwargs):
+        """Evaluate the unperturbed model on the environment or the validation environment.
+        """
+        return self.eval_fun(self.model, self.val_env if validate else self.env, 42, **kwargs)
+
     def train(self):
         def draw_seeds(n):
             seeds = torch.LongTensor(n).random_()
@@ -899,12 +1172,14 @@ class StochasticGradientEstimation(Algorithm):
             start_generation = self.lr_scheduler.last_epoch + 1
             max_unperturbed_return = self._max_unp_return
         # Initialize variables independent of state
-        if self.workers > 1: pool = mp.Pool(processes=self.workers)
-        if self.track_parallel and "DISPLAY" in os.environ: pb = PoolProgress(pool, update_interval=.5, keep_after_done=False, title='Evaluating perturbations')
+        if self.workers > 1: pool = mp.Pool(processes=self.workers, initializer=_init_worker, initargs=(self.env, self.val_env))
+        pb = ProgressBar(keep_after_done=False, title='Evaluating perturbations') if self.track_parallel and "DISPLAY" in os.environ else None
         best_algorithm_stdct = None
         best_model_stdct = None
         best_optimizer_stdct = None
         last_checkpoint_time = time.time()
+        chkpt_executor = ThreadPoolExecutor(max_workers=1)
+        chkpt_job = None
         chunksize = self.perturbations // (10 * self.workers) + int(self.perturbations // (10 * self.workers) == 0)
         eval_kwargs = {'max_episode_length': self.batch_size, 'chunksize': chunksize}
         # eval_kwargs_unp = {'max_episode_length': self.batch_size, 'collect_inputs': hasattr(self.env, 'env'), 'chunksize': chunksize}
@@ -925,203 +1200,215 @@ class StochasticGradientEstimation(Algorithm):
         n_rejected = 0
 
         # Start training loop
-        for n_generation in range(start_generation, self.max_generations):
-            # Compute parent model weight-output sensitivities
-            self.compute_sensitivities()
-
-            # Generate random seeds
-            if self.forced_refresh == 0:
-                # Regular sampling
-                seeds = draw_seeds(int(self.perturbations/((not self.no_antithetic) + 1)))
-                assert len(seeds) == self.perturbations, 'Number of created seeds is not equal to wanted perturbations'
-            elif 'seeds' in locals() and 0.0 < self.forced_refresh < 1.0:
-                # Importance mixing
-                if 'reused_ids' in locals():
-                    rids = list(reused_ids)
-                seeds, reused_seeds, reused_ids, n_rejected = self.importance_mixing(seeds, (current_weights, current_sigma), (previous_weights, previous_sigma))
-                print(" | RU " + str(len(reused_seeds)), end='')
-                if 'rids' in locals():
-                    print(' | 2RU ' + str(np.sum(np.array(rids) == np.array(reused_ids))), end='')
-                print(" | RJ " + str(n_rejected), end='')
-            elif 'seeds' in locals() and isint(self.forced_refresh) and self.forced_refresh >= 0:
-                if 'reused_ids' in locals():
-                    rids = list(reused_ids)
-                # # Percentile
-                # percentile = np.percentile(workers_out['return'], 99)
-                # reused_ids = np.where(workers_out['return'] > percentile)[0]
-                # reused_seeds = seeds[reused_ids.tolist()]
-                # reused_return = workers_out['return'][reused_ids]
-
-                # # Better than unperturbed
-                # return_unp = unperturbed_out['return']
-                # reused_ids = np.where(workers_out['return'] > return_unp)[0]
-                # reused_seeds = seeds[reused_ids.tolist()]
-                # reused_return = workers_out['return'][reused_ids]
-
-                # # Using percentile of those better than unperturbed
-                # return_unp = unperturbed_out['return']
-                # percentile = np.percentile(workers_out['return'], 90)
-                # reused_ids = np.where(np.logical_and(workers_out['return'] > return_unp, workers_out['return'] > percentile))[0]
-                # reused_seeds = seeds[reused_ids.tolist()] if reused_ids.tolist() else torch.LongTensor([])
-                # reused_return = workers_out['return'][reused_ids]
-                
-                # # Using 2%-tile worst and best
-                # percentile = np.percentile(workers_out['return'], 98)
-                # reused_ids = workers_out['return'] > percentile
-                # percentile = np.percentile(workers_out['return'], 2)
-                # reused_ids = np.where(np.logical_or(reused_ids, workers_out['return'] < percentile))[0]
-                # reused_seeds = seeds[reused_ids.tolist()]
-                # reused_return = workers_out['return'][reused_ids]
-
-                # Random reuse
-                n_reused = int(self.perturbations) - int(self.forced_refresh)
-                reused_ids = np.random.randint(0, self.perturbations, size=n_reused)
-                reused_seeds = seeds[reused_ids.tolist()] if reused_ids.tolist() else torch.LongTensor([])
-                reused_return = workers_out['return'][reused_ids]
-
-                # Regular sampling of the new seeds
-                seeds = draw_seeds(int(self.perturbations/((not self.no_antithetic) + 1)))
-                print(" | RU " + str(len(reused_seeds)), end='')
-                if 'rids' in locals():
-                    print('| 2RU ' + str(np.sum(np.array(rids) == np.array(reused_ids))), end='')
-            else:
-                # Online updated linear basis function model on samples (i.e. seen network weights) with objective function as target
-                if 'seeds' in locals():
-                    # Standard (MSE)
-                    # w = w + eta * (t_n - w' * phi_n) * phi_n
-                    MSE = 0
-                    for r, s in zip(workers_out['return'], seeds):
-                        network_weights = self.generate_sample(s, self._modelrepr2vec(current_weights), current_sigma)
-                        network_weights.apply_(LBF_basis_fcn)
-                        network_weights = torch.cat([network_weights, torch.FloatTensor([1])])
-                        prediction = LBF_weights @ network_weights
-                        LBF_weights += LBF_eta * (r - prediction) * network_weights
-                        MSE += (r - prediction) ** 2
-                    MSE /= 2
-                    print(' | LBF_MSE {:4.2f}'.format(MSE), end='')
-
-                    prediction = LBF_weights @ torch.cat([self._modelrepr2vec(current_weights).apply_(LBF_basis_fcn), torch.FloatTensor([1])])
-                    print(' | LBF_Pr {:4.2f}'.format(prediction), end='')
-
-                    # Regularized (MSE)
-                    # w = w + eta * (t_n - w' * phi_n) * phi_n + lambda * w
-
-                    n_rejected = 0
-                    seeds = torch.LongTensor(int(self.perturbations/((not self.no_antithetic) + 1))).random_()
-                    if not self.no_antithetic: seeds = torch.cat([seeds, -seeds])
-                    assert len(seeds) == self.perturbations, 'Number of created seeds is not equal to wanted perturbations'
-
-                else:
-                    # First time
-                    LBF_n_weights = self.model.count_parameters(only_trainable=True) + 1
-                    LBF_weights = torch.FloatTensor(LBF_n_weights).normal_()
-                    LBF_s = 1
-                    LBF_basis_fcn = lambda x: np.exp(- x**2 / 2) # (2 * LBF_s**2))
-                    LBF_eta = 1e-7
-
-                    n_rejected = 0
-                    seeds = torch.LongTensor(int(self.perturbations/((not self.no_antithetic) + 1))).random_()
-                    if not self.no_antithetic: seeds = torch.cat([seeds, -seeds])
+        try:
+            for n_generation in range(start_generation, self.max_generations):
+                # Compute parent model weight-output sensitivities
+                self.compute_sensitivities()
+
+                # Generate random seeds
+                if self.forced_refresh == 0:
+                    # Regular sampling
+                    seeds = draw_seeds(int(self.perturbations/((not self.no_antithetic) + 1)))
                     assert len(seeds) == self.perturbations, 'Number of created seeds is not equal to wanted perturbations'
-
-            # Get master seed for Common Random Numbers
-            if self.common_random_numbers:
-                eval_kwargs['mseed'] = draw_seeds(1)[0]
-                eval_kwargs_unp['mseed'] = eval_kwargs['mseed']
-            # unperturbed_out = self.eval_fun(self.model, self.env, 42, **eval_kwargs_unp)
-
-            # Evaluate perturbations
-            workers_start_time = time.time()
-            if self.workers > 1:
-                # Execute all perturbations on the pool of processes
-                workers_out = pool.map_async(partial(self._eval_wrap, **eval_kwargs), seeds)
-                unperturbed_out = pool.apply_async(self.eval_fun, (self.model, self.env, 42), eval_kwargs_unp)
-                if self.val_env is not None and n_generation % self.val_every == 0:
-                    model_class = type(self.model)
-                    val_model = model_class(self.env.observation_space, self.env.action_space) if hasattr(self.env, 'observation_space') else model_class()
-                    val_model.load_state_dict(self.model.state_dict())
-                    val_model.zero_grad()
-                    val_model.eval()
-                    unperturbed_val_out = pool.apply_async(self.eval_fun, (self.model, self.val_env, 42))
+                elif 'seeds' in locals() and 0.0 < self.forced_refresh < 1.0:
+                    # Importance mixing
+                    if 'reused_ids' in locals():
+                        rids = list(reused_ids)
+                    seeds, reused_seeds, reused_ids, n_rejected = self.importance_mixing(seeds, (current_weights, current_sigma), (previous_weights, previous_sigma))
+                    print(" | RU " + str(len(reused_seeds)), end='')
+                    if 'rids' in locals():
+                        print(' | 2RU ' + str(np.sum(np.array(rids) == np.array(reused_ids))), end='')
+                    print(" | RJ " + str(n_rejected), end='')
+                elif 'seeds' in locals() and isint(self.forced_refresh) and self.forced_refresh >= 0:
+                    if 'reused_ids' in locals():
+                        rids = list(reused_ids)
+                    # # Percentile
+                    # percentile = np.percentile(workers_out['return'], 99)
+                    # reused_ids = np.where(workers_out['return'] > percentile)[0]
+                    # reused_seeds = seeds[reused_ids.tolist()]
+                    # reused_return = workers_out['return'][reused_ids]
+
+                    # # Better than unperturbed
+                    # return_unp = unperturbed_out['return']
+                    # reused_ids = np.where(workers_out['return'] > return_unp)[0]
+                    # reused_seeds = seeds[reused_ids.tolist()]
+                    # reused_return = workers_out['return'][reused_ids]
+
+                    # # Using percentile of those better than unperturbed
+                    # return_unp = unperturbed_out['return']
+                    # percentile = np.percentile(workers_out['return'], 90)
+                    # reused_ids = np.where(np.logical_and(workers_out['return'] > return_unp, workers_out['return'] > percentile))[0]
+                    # reused_seeds = seeds[reused_ids.tolist()] if reused_ids.tolist() else torch.LongTensor([])
+                    # reused_return = workers_out['return'][reused_ids]
+                
+                    # # Using 2%-tile worst and best
+                    # percentile = np.percentile(workers_out['return'], 98)
+                    # reused_ids = workers_out['return'] > percentile
+                    # percentile = np.percentile(workers_out['return'], 2)
+                    # reused_ids = np.where(np.logical_or(reused_ids, workers_out['return'] < percentile))[0]
+                    # reused_seeds = seeds[reused_ids.tolist()]
+                    # reused_return = workers_out['return'][reused_ids]
+
+                    # Random reuse
+                    n_reused = int(self.perturbations) - int(self.forced_refresh)
+                    reused_ids = np.random.randint(0, self.perturbations, size=n_reused)
+                    reused_seeds = seeds[reused_ids.tolist()] if reused_ids.tolist() else torch.LongTensor([])
+                    reused_return = workers_out['return'][reused_ids]
+
+                    # Regular sampling of the new seeds
+                    seeds = draw_seeds(int(self.perturbations/((not self.no_antithetic) + 1)))
+                    print(" | RU " + str(len(reused_seeds)), end='')
+                    if 'rids' in locals():
+                        print('| 2RU ' + str(np.sum(np.array(rids) == np.array(reused_ids))), end='')
                 else:
-                    unperturbed_val_out = None
-                if self.track_parallel and "DISPLAY" in os.environ: pb.track(workers_out)
-                workers_out = workers_out.get(timeout=3600)
-                unperturbed_out = unperturbed_out.get(timeout=3600)
-                if unperturbed_val_out is None:
-                    unperturbed_val_out = {k: None for k in unperturbed_out.keys()}
+                    # Online updated linear basis function model on samples (i.e. seen network weights) with objective function as target
+                    if 'seeds' in locals():
+                        # Standard (MSE)
+                        # w = w + eta * (t_n - w' * phi_n) * phi_n
+                        MSE = 0
+                        for r, s in zip(workers_out['return'], seeds):
+                            network_weights = self.generate_sample(s, self._modelrepr2vec(current_weights), current_sigma)
+                            network_weights.apply_(LBF_basis_fcn)
+                            network_weights = torch.cat([network_weights, torch.FloatTensor([1])])
+                            prediction = LBF_weights @ network_weights
+                            LBF_weights += LBF_eta * (r - prediction) * network_weights
+                            MSE += (r - prediction) ** 2
+                        MSE /= 2
+                        print(' | LBF_MSE {:4.2f}'.format(MSE), end='')
+
+                        prediction = LBF_weights @ torch.cat([self._modelrepr2vec(current_weights).apply_(LBF_basis_fcn), torch.FloatTensor([1])])
+                        print(' | LBF_Pr {:4.2f}'.format(prediction), end='')
+
+                        # Regularized (MSE)
+                        # w = w + eta * (t_n - w' * phi_n) * phi_n + lambda * w
+
+                        n_rejected = 0
+                        seeds = torch.LongTensor(int(self.perturbations/((not self.no_antithetic) + 1))).random_()
+                        if not self.no_antithetic: seeds = torch.cat([seeds, -seeds])
+                        assert len(seeds) == self.perturbations, 'Number of created seeds is not equal to wanted perturbations'
+
+                    else:
+                        # First time
+                        LBF_n_weights = self.model.count_parameters(only_trainable=True) + 1
+                        LBF_weights = torch.FloatTensor(LBF_n_weights).normal_()
+                        LBF_s = 1
+                        LBF_basis_fcn = lambda x: np.exp(- x**2 / 2) # (2 * LBF_s**2))
+                        LBF_eta = 1e-7
+
+                        n_rejected = 0
+                        seeds = torch.LongTensor(int(self.perturbations/((not self.no_antithetic) + 1))).random_()
+                        if not self.no_antithetic: seeds = torch.cat([seeds, -seeds])
+                        assert len(seeds) == self.perturbations, 'Number of created seeds is not equal to wanted perturbations'
+
+                # Get master seed for Common Random Numbers
+                if self.common_random_numbers:
+                    eval_kwargs['mseed'] = draw_seeds(1)[0]
+                    eval_kwargs_unp['mseed'] = eval_kwargs['mseed']
+                # unperturbed_out = self.eval_fun(self.model, self.env, 42, **eval_kwargs_unp)
+
+                # Draw the perturbations of this generation
+                self.generate_perturbations(torch.cat([seeds, torch.LongTensor(reused_seeds)]))
+
+                # Evaluate perturbations
+                workers_start_time = time.time()
+                if self.workers > 1:
+                    # Share the parent model with the workers instead of copying it to each task
+                    self._share_with_workers()
+                    # Execute all perturbations on the pool of processes
+                    unperturbed_out = pool.apply_async(self._eval_unperturbed, kwds=eval_kwargs_unp)
+                    if self.val_env is not None and n_generation % self.val_every == 0:
+                        unperturbed_val_out = pool.apply_async(self._eval_unperturbed, kwds={'validate': True})
+                    else:
+                        unperturbed_val_out = None
+                    if self.batch_eval_fun is not None:
+                        workers_out = self._eval_batched(seeds, **eval_kwargs)
+                    else:
+                        workers_out = self._collect(pool.imap_unordered(partial(self._eval_wrap, **eval_kwargs), seeds, chunksize=chunksize), len(seeds), pb)
+                    unperturbed_out = unperturbed_out.get(timeout=3600)
+                    if unperturbed_val_out is None:
+                        unperturbed_val_out = {k: None for k in unperturbed_out.keys()}
+                    else:
+                        unperturbed_val_out = unperturbed_val_out.get(timeout=3600)
                 else:
-                    unperturbed_val_out = unperturbed_val_out.get(timeout=3600)
-            else:
-                # Execute sequentially
-                unperturbed_out = self.eval_fun(self.model, self.env, 42, **eval_kwargs_unp)
-                if self.val_env is not None and n_generation % self.val_every == 0:
-                    unperturbed_val_out = self.eval_fun(self.model, self.val_env, 42)
-                else:
-                    unperturbed_val_out = {k: None for k in unperturbed_out.keys()}
-                workers_out = []
-                for s in seeds:
-                    workers_out.append(self._eval_wrap(s, **eval_kwargs))
-            workers_time = time.time() - workers_start_time
-            assert 'return' in unperturbed_out.keys() and 'seed' in unperturbed_out.keys(), "The `eval_fun` must give a return and repass the used seed"
-            if hasattr(self.env, 'env'):
-                self.sens_inputs = torch.from_numpy(unperturbed_out['inputs'])
-
-            # Invert output from list of dicts to dict of lists
-            workers_out = dict(zip(workers_out[0], zip(*[d.values() for d in workers_out])))
-
-            # Recast all outputs as np.ndarrays and seeds as torch.LongTensor
-            for k, v in filter(lambda i: i[0] != 'seed', workers_out.items()): workers_out[k] = np.array(v)
-            workers_out['seed'] = torch.LongTensor(workers_out['seed'])
-
-            # Append reused seeds and returns (importance mixing)
-            assert (seeds == workers_out['seed']).all(), 'The generated seeds must be the same as those returned by workers (plus reused seeds)'
-            workers_out['return'] = np.append(workers_out['return'], reused_return)  # Order is important (resampling combined with returns later)
-            workers_out['seed'] = torch.cat([workers_out['seed'], reused_seeds])  # Order is important (resampling combined with returns later)
-            seeds = torch.cat([seeds, torch.LongTensor(reused_seeds)])  # Order is important (resampling combined with returns later)
-            # assert self.perturbations <= len(workers_out['seed']) <= self.perturbations + 1
+                    # Execute sequentially
+                    unperturbed_out = self.eval_fun(self.model, self.env, 42, **eval_kwargs_unp)
+                    if self.val_env is not None and n_generation % self.val_every == 0:
+                        unperturbed_val_out = self.eval_fun(self.model, self.val_env, 42)
+                    else:
+                        unperturbed_val_out = {k: None for k in unperturbed_out.keys()}
+                    if self.batch_eval_fun is not None:
+                        workers_out = self._eval_batched(seeds, **eval_kwargs)
+                    else:
+                        workers_out = []
+                        for s in seeds:
+                            workers_out.append(self._eval_wrap(s, **eval_kwargs))
+                workers_time = time.time() - workers_start_time
+                assert 'return' in unperturbed_out.keys() and 'seed' in unperturbed_out.keys(), "The `eval_fun` must give a return and repass the used seed"
+                if hasattr(self.env, 'env'):
+                    self.sens_inputs = torch.from_numpy(unperturbed_out['inputs'])
+
+                # Invert output from list of dicts to dict of lists
+                workers_out = dict(zip(workers_out[0], zip(*[d.values() for d in workers_out])))
+
+                # Recast all outputs as np.ndarrays and seeds as torch.LongTensor
+                for k, v in filter(lambda i: i[0] != 'seed', workers_out.items()): workers_out[k] = np.array(v)
+                workers_out['seed'] = torch.LongTensor(workers_out['seed'])
+
+                # Append reused seeds and returns (importance mixing)
+                assert sorted(seeds.tolist()) == sorted(workers_out['seed'].tolist()), 'The generated seeds must be the same as those returned by workers (plus reused seeds)'
+                seeds = workers_out['seed'].clone()  # Workers return in order of completion
+                workers_out['return'] = np.append(workers_out['return'], reused_return)  # Order is important (resampling combined with returns later)
+                workers_out['seed'] = torch.cat([workers_out['seed'], reused_seeds])  # Order is important (resampling combined with returns later)
+                seeds = torch.cat([seeds, torch.LongTensor(reused_seeds)])  # Order is important (resampling combined with returns later)
+                # assert self.perturbations <= len(workers_out['seed']) <= self.perturbations + 1
             
-            # Shaping, rank and compute gradients
-            rank = self.unperturbed_rank(workers_out['return'], unperturbed_out['return'])
-            shaped_returns = self.fitness_shaping(workers_out['return'])
-            self.compute_gradients(shaped_returns, workers_out['seed'])
-
-            # Adaptation sampling
-            if type(self.optimizer) == torch.optim.SGD and self.adaptation_sampling:
-                self.adaptation_sampling_learning_rate_update(workers_out['return'], seeds, (current_weights, current_sigma), (0))
-                self.adaptation_sampling_learning_rate_update(workers_out['return'], seeds, (current_weights, current_sigma), (1))
-
-            # Update the parameters
-            self.model.cpu()  # TODO Find out why the optimizer requires model on CPU even with args.cuda = True
-            self.optimizer.step()
-            if type(self.lr_scheduler) == torch.optim.lr_scheduler.ReduceLROnPlateau:
-                self.lr_scheduler.step(unperturbed_out['return'])
-            else:
-                self.lr_scheduler.step()
+                # Shaping, rank and compute gradients
+                rank = self.unperturbed_rank(workers_out['return'], unperturbed_out['return'])
+                shaped_returns = self.fitness_shaping(workers_out['return'])
+                self.compute_gradients(shaped_returns, workers_out['seed'])
+
+                # Adaptation sampling
+                if type(self.optimizer) == torch.optim.SGD and self.adaptation_sampling:
+                    self.adaptation_sampling_learning_rate_update(workers_out['return'], seeds, (current_weights, current_sigma), (0))
+                    self.adaptation_sampling_learning_rate_update(workers_out['return'], seeds, (current_weights, current_sigma), (1))
+
+                # Update the parameters
+                self.optimizer.step()
+                if type(self.lr_scheduler) == torch.optim.lr_scheduler.ReduceLROnPlateau:
+                    self.lr_scheduler.step(unperturbed_out['return'])
+                else:
+                    self.lr_scheduler.step()
+
+                # Update previous and current weights (importance mixing)
+                # previous_weights = list(current_weights)
+                # previous_sigma = current_sigma.clone()
+                # current_weights = []
+                # for p in self.model.parameters():
+                #     current_weights.append(p.data.clone())
+                # current_sigma = self._beta2sigma(self.beta.data)
+
+                # Keep track of best model
+                if unperturbed_out['return'] >= max_unperturbed_return:
+                    best_model_stdct = self.model.state_dict()
+                    best_optimizer_stdct = self.optimizer.state_dict()
+                    best_algorithm_stdct = self.state_dict(exclude=True)
+                    max_unperturbed_return = unperturbed_out['return']
+
+                # Print and checkpoint
+                self._store_stats(workers_out, unperturbed_out, unperturbed_val_out, n_generation, rank, workers_time, len(reused_seeds), n_rejected)
+                self.print_iter()
+                if last_checkpoint_time < time.time() - self.chkpt_int:
+                    # Write in the background once the previous checkpoint is written
+                    if chkpt_job is not None:
+                        chkpt_job.result()
+                    chkpt_job = self.save_checkpoint(best_model_stdct, best_optimizer_stdct, best_algorithm_stdct, plot=True, executor=chkpt_executor)
+                    last_checkpoint_time = time.time()
+        finally:
+            # Wait for a checkpoint being written in the background, also when training is interrupted
+            if chkpt_job is not None:
+                chkpt_job.result()
+            chkpt_executor.shutdown(wait=True)
 
-            # Update previous and current weights (importance mixing)
-            # previous_weights = list(current_weights)
-            # previous_sigma = current_sigma.clone()
-            # current_weights = []
-            # for p in self.model.parameters():
-            #     current_weights.append(p.data.clone())
-            # current_sigma = self._beta2sigma(self.beta.data)
-
-            # Keep track of best model
-            if unperturbed_out['return'] >= max_unperturbed_return:
-                best_model_stdct = self.model.state_dict()
-                best_optimizer_stdct = self.optimizer.state_dict()
-                best_algorithm_stdct = self.state_dict(exclude=True)
-                max_unperturbed_return = unperturbed_out['return']
-
-            # Print and checkpoint
-            self._store_stats(workers_out, unperturbed_out, unperturbed_val_out, n_generation, rank, workers_time, len(reused_seeds), n_rejected)
-            self.print_iter()
-            if last_checkpoint_time < time.time() - self.chkpt_int:
-                self.save_checkpoint(best_model_stdct, best_optimizer_stdct, best_algorithm_stdct)
-                plot_stats(os.path.join(self.chkpt_dir, 'stats.csv'), self.chkpt_dir)
-                last_checkpoint_time = time.time()
-        
         # End training
         self.save_checkpoint(best_model_stdct, best_optimizer_stdct, best_algorithm_stdct)
         if self.workers > 1:
@@ -1145,7 +1432,7 @@ class ES(StochasticGradientEstimation):
         if self.optimize_sigma is not None:
             beta_val = self._sigma2beta(sigma)
             lr = cov_lr if cov_lr else self.lr_scheduler.get_lr()[0]
-            beta_par = {'label': '_beta', 'params': Variable(torch.Tensor([beta_val]), requires_grad=True),
+            beta_par = {'label': '_beta', 'params': torch.Tensor([beta_val]).requires_grad_(),
                         'lr': lr, 'weight_decay': 0, 'momentum': 0.9, 'dampening': 0.9}
             self._beta = self._add_parameter_to_optimize(beta_par)
         # Add learning rates to stats
@@ -1155,14 +1442,14 @@ class ES(StochasticGradientEstimation):
     def _store_stats(self, *args):
         super(ES, self)._store_stats(*args)
         self.stats['sigma'].append(self.sigma)
-        self.stats['beta'].append(self.beta.data[0])
+        self.stats['beta'].append(self.beta.data[0].item())
 
     @property
     def beta(self):
         if self.optimize_sigma:
             assert type(self._beta) is dict and 'params' in self._beta
             beta = self._beta['params'][0]
-            self.sigma = self._beta2sigma(beta.data[0])
+            self.sigma = self._beta2sigma(beta.data[0].item())
         else:
             beta = self._sigma2beta(self.sigma)
         return beta
@@ -1186,32 +1473,24 @@ class ES(StochasticGradientEstimation):
     def perturb_model(self, seed):
         """Perturbs the main model.
         """
-        # Get model class and instantiate new models as copies of parent
-        model_class = type(self.model)
-        perturbed_model = model_class(self.env.observation_space, self.env.action_space) if hasattr(self.env, 'observation_space') else model_class()
-        perturbed_model.load_state_dict(self.model.state_dict())
-        perturbed_model.zero_grad()
+        # Get the copy of the parent model of this process
+        perturbed_model = self._copy_model()
         # Handle antithetic sampling
         sign = np.sign(seed)
-        # Set seed and permute by isotropic Gaussian noise
-        torch.manual_seed(abs(seed))
-        torch.cuda.manual_seed(abs(seed))
-        for pp, sens in zip_longest(perturbed_model.parameters(), self.sensitivities):
-            eps = self.get_perturbation(pp.size(), sensitivities=sens)
+        # Permute by isotropic Gaussian noise
+        for pp, eps in zip(perturbed_model.parameters(), self.get_cached_perturbation(seed)):
             pp.data += sign * self.sigma * eps
-            if np.isnan(pp.data).any():
-                print(pp.data)
-                print(sens)
-                print(eps)
-            assert not np.isnan(pp.data).any()
-            assert not np.isinf(pp.data).any()
+            self._check_finite(pp.data)
         return perturbed_model
 
-    def weight_gradient(self, retrn, eps):
-        return 1 / (self.perturbations * self.sigma) * (retrn * eps)
+    def _perturbation_scale(self):
+        return self.sigma
+
+    def weight_gradient(self, returns, eps):
+        return 1 / (self.perturbations * self.sigma) * eps.t().mv(returns)
 
-    def beta_gradient(self, retrn, eps):
-        return 1 / (2 * self.perturbations) * retrn * (eps.pow(2).sum() - eps.numel())
+    def beta_gradient(self, returns, eps):
+        return 1 / (2 * self.perturbations) * returns.dot(eps.pow(2).sum(dim=1) - eps.size(1))
 
     def compute_gradients(self, returns, seeds):
         """Computes the gradients of the weights of the model wrt. to the return. 
@@ -1219,39 +1498,21 @@ class ES(StochasticGradientEstimation):
         The gradients will point in the direction of change in the weights resulting in a
         decrease in the return.
         """
-        # CUDA
-        if self.cuda:
-            self.model.cuda()
-
-        ## Indpendent parameter groups sampling
-        # Preallocate list with gradients
-        weight_gradients = []
-        beta_gradient = torch.zeros(1)
-        for param in self.model.parameters():
-            weight_gradients.append(torch.zeros(param.data.size()))
-
-        # Compute gradients
-        for i, retrn in enumerate(returns):
-            # Set random seed, get antithetic multiplier and return
-            sign = np.sign(seeds[i])
-            torch.manual_seed(abs(seeds[i]))
-            torch.cuda.manual_seed(abs(seeds[i]))
-            for layer, param in enumerate(self.model.parameters()):
-                eps = self.get_perturbation(param.size(), sensitivities=self.sensitivities[layer], cuda=self.cuda)
-                weight_gradients[layer] += self.weight_gradient(sign * retrn, eps)
-                if self.optimize_sigma:
-                    beta_gradient += self.beta_gradient(retrn, eps)
+        # Compute gradients as products of the perturbation matrix and the (signed) returns
+        signed_returns, unsigned_returns = self._perturbation_returns(returns, seeds)
+        eps = self._perturbation_cache
+        weight_gradients = self._vec2modelrepr(self.weight_gradient(signed_returns, eps))
+        if self.optimize_sigma:
+            beta_gradient = torch.Tensor([self.beta_gradient(unsigned_returns, eps)])
 
         # Set gradients
         self.optimizer.zero_grad()
         for layer, param in enumerate(self.model.parameters()):
-            param.grad.data = - weight_gradients[layer]
-            assert not np.isnan(param.grad.data).any()
-            assert not np.isinf(param.grad.data).any()
+            param.grad = - weight_gradients[layer].to(param.device)
+            self._check_finite(param.grad)
         if self.optimize_sigma:
-            self.beta.grad = - Variable(beta_gradient, requires_grad=True)
-            assert not np.isnan(self.beta.grad.data).any()
-            assert not np.isinf(self.beta.grad.data).any()
+            self.beta.grad = - beta_gradient
+            self._check_finite(self.beta.grad)
 
     def print_init(self):
         super(ES, self).print_init()
@@ -1278,16 +1539,16 @@ class NES(ES):
         self._weight_update_scale = 1/self.sigma**2
         # self._beta_update_scale = 1/(2*self.sigma**4)
 
-    def weight_gradient(self, retrn, eps):
+    def weight_gradient(self, returns, eps):
         # Equal to sigma^2 * [regular gradient] (1 / (self.perturbations * self.sigma) * (retrn * eps))
         # To rescale gradients to same size as for ES, we multiply by a factor of 1/sigma_0**2 where
         # sigma_0 is the initial sigma value
-        return self._weight_update_scale * (self.sigma / self.perturbations) * (retrn * eps)
+        return self._weight_update_scale * (self.sigma / self.perturbations) * eps.t().mv(returns)
 
-    def beta_gradient(self, retrn, eps):
+    def beta_gradient(self, returns, eps):
         # Equal to 1/2 * [regular gradient] (1 / (2 * self.perturbations) * retrn * (eps.pow(2).sum() - eps.numel()))
         # Since the natural gradient is independent of beta, there is no scaling required.
-        return retrn * (eps.pow(2).sum() - eps.numel()) / (2 * self.perturbations)
+        return returns.dot(eps.pow(2).sum(dim=1) - eps.size(1)) / (2 * self.perturbations)
 
 
 class sES(StochasticGradientEstimation):
@@ -1318,7 +1579,7 @@ class sES(StochasticGradientEstimation):
         # Add sigma to optimizer and lr_scheduler
         beta = self._sigma2beta(sigma)
         if self.optimize_sigma is None:
-            self._beta = Variable(torch.Tensor([beta]), requires_grad=False)
+            self._beta = torch.Tensor([beta])
         else:
             if self.optimize_sigma == 'single':
                 assert not isinstance(sigma, (collections.Sequence, np.ndarray, torch.Tensor))
@@ -1341,7 +1602,7 @@ class sES(StochasticGradientEstimation):
                 lr = cov_lr
             else:
                 lr = self.lr_scheduler.get_lr()[0]
-            beta_par = {'label': '_beta', 'params': Variable(beta_tensor, requires_grad=True),
+            beta_par = {'label': '_beta', 'params': beta_tensor.requires_grad_(),
                         'lr': lr, 'weight_decay': 0, 'momentum': 0.9, 'dampening': 0.9}
             self._beta = self._add_parameter_to_optimize(beta_par)
         self.sigma = self._beta2sigma(self.beta.data)
@@ -1352,7 +1613,7 @@ class sES(StochasticGradientEstimation):
     def _store_stats(self, *args):
         super(sES, self)._store_stats(*args)
         self.stats['sigma'].append(self.sigma)
-        self.stats['beta'].append(self.beta.data[0])
+        self.stats['beta'].append(self.beta.data[0].item())
 
     @property
     def beta(self):
@@ -1379,43 +1640,40 @@ class sES(StochasticGradientEstimation):
     def _beta2sigma(beta):
         return np.sqrt(np.exp(beta))
     
+    def _perturbation_scale(self):
+        if self.optimize_sigma == 'per-layer':
+            return torch.cat([s.expand(p.numel()) for p, s in zip(self.model.parameters(), self.sigma)])
+        return self.sigma
+
     def perturb_model(self, seed):
         """Perturbs the main model.
         """
-        # Get model class and instantiate new models as copies of parent
-        model_class = type(self.model)
-        perturbed_model = model_class(self.env.observation_space, self.env.action_space) if hasattr(self.env, 'observation_space') else model_class()
-        perturbed_model.load_state_dict(self.model.state_dict())
-        perturbed_model.zero_grad()
+        # Get the copy of the parent model of this process
+        perturbed_model = self._copy_model()
         # Handle antithetic sampling
         sign = np.sign(seed)
-        # Set seed and permute by isotropic Gaussian noise
-        torch.manual_seed(abs(seed))
-        torch.cuda.manual_seed(abs(seed))
+        # Permute by Gaussian noise
+        perturbation = self.get_cached_perturbation(seed)
         if self.optimize_sigma in [None, 'single']:
-            for p, pp, sens in zip_longest(self.model.parameters(), perturbed_model.parameters(), self.sensitivities):
-                eps = sign * self.get_perturbation(p.size(), sensitivities=sens)
-                pp.data += self.sigma * eps
+            for pp, eps in zip(perturbed_model.parameters(), perturbation):
+                pp.data += sign * self.sigma * eps
             # print("Perturb model")
             # print(type(seed))
             # print(type(sign))
             # print(seed)
             # print(eps) # REMOVE
         elif self.optimize_sigma == 'per-layer':
-            for layer, (p, pp, sens) in enumerate(zip_longest(self.model.parameters(), perturbed_model.parameters(), self.sensitivities)):
-                eps = self.get_perturbation(p.size(), sensitivities=sens)
+            for layer, (pp, eps) in enumerate(zip(perturbed_model.parameters(), perturbation)):
                 pp.data += sign * self.sigma[layer] * eps
         elif self.optimize_sigma == 'per-weight':
             i = 0
-            for layer, (p, pp, sens) in enumerate(zip_longest(self.model.parameters(), perturbed_model.parameters(), self.sensitivities)):
-                j = i + p.numel()
-                eps = self.get_perturbation(p.size(), sensitivities=sens)
-                pp.data += sign * (self.sigma[i:j] * eps.view(-1)).view(p.size())
+            for pp, eps in zip(perturbed_model.parameters(), perturbation):
+                j = i + pp.numel()
+                pp.data += sign * (self.sigma[i:j] * eps.view(-1)).view(pp.size())
                 i = j
         # Check numerical values
         for pp in perturbed_model.parameters():
-            assert not np.isnan(pp.data).any()
-            assert not np.isinf(pp.data).any()
+            self._check_finite(pp.data)
         return perturbed_model
 
     def compute_gradients(self, returns, seeds):
@@ -1424,49 +1682,35 @@ class sES(StochasticGradientEstimation):
         The gradients will point in the direction of change in the weights resulting in a
         decrease in the return.
         """
-        # CUDA
-        if self.cuda:
-            self.model.cuda()
-        
-        # Preallocate list with gradients
-        weight_gradients = []
-        for param in self.model.parameters():
-            weight_gradients.append(torch.zeros(param.data.size()))
+        # Compute gradients as products of the perturbation matrix and the (signed) returns
+        signed_returns, unsigned_returns = self._perturbation_returns(returns, seeds)
+        eps = self._perturbation_cache
         beta_gradients = torch.zeros(self.beta.size())
-
-        # Compute gradients
-        for i, retrn in enumerate(returns):
-            # Set random seed, get antithetic multiplier and return
-            sign = np.sign(seeds[i])
-            torch.manual_seed(abs(seeds[i]))
-            torch.cuda.manual_seed(abs(seeds[i]))
+        if self.optimize_sigma in [None, 'single']:
+            weight_gradients = (1 / (self.perturbations * self.sigma)) * eps.t().mv(signed_returns)
+            if self.optimize_sigma == 'single':
+                beta_gradients += 1 / (2 * self.perturbations) * unsigned_returns.dot(eps.pow(2).sum(dim=1) - eps.size(1))
+        elif self.optimize_sigma == 'per-layer':
+            weight_gradients = torch.zeros(eps.size(1))
             i = 0
             for layer, param in enumerate(self.model.parameters()):
-                eps = self.get_perturbation(param.size(), sensitivities=self.sensitivities[layer], cuda=self.cuda)
-                if not self.optimize_sigma:
-                    weight_gradients[layer] += (1 / (self.perturbations * self.sigma)) * (sign * retrn * eps)
-                if self.optimize_sigma == 'single':
-                    weight_gradients[layer] += (1 / (self.perturbations * self.sigma)) * (sign * retrn * eps)
-                    beta_gradients += 1 / ( 2 * self.perturbations) * retrn * (eps.pow(2).sum() - eps.numel())
-                elif self.optimize_sigma == 'per-layer':
-                    weight_gradients[layer] += (1 / (self.perturbations * self.sigma[layer])) * (sign * retrn * eps)
-                    beta_gradients[layer] += 1 / ( 2 * self.perturbations) * retrn * (eps.pow(2).sum() - eps.numel())
-                elif self.optimize_sigma == 'per-weight':
-                    j = i + param.numel()
-                    weight_gradients[layer] += (1 / (self.perturbations * self.sigma[i:j].view(weight_gradients[layer].size()))) * (sign * retrn * eps)
-                    beta_gradients[i:j] += 1 / ( 2 * self.perturbations) * retrn * (eps.view(-1).pow(2) - 1)
-                    i = j
-  
+                j = i + param.numel()
+                weight_gradients[i:j] = (1 / (self.perturbations * self.sigma[layer])) * eps[:, i:j].t().mv(signed_returns)
+                beta_gradients[layer] = 1 / (2 * self.perturbations) * unsigned_returns.dot(eps[:, i:j].pow(2).sum(dim=1) - param.numel())
+                i = j
+        elif self.optimize_sigma == 'per-weight':
+            weight_gradients = (1 / (self.perturbations * self.sigma)) * eps.t().mv(signed_returns)
+            beta_gradients = 1 / (2 * self.perturbations) * (eps.pow(2).t().mv(unsigned_returns) - unsigned_returns.sum())
+        weight_gradients = self._vec2modelrepr(weight_gradients)
+
         # Set gradients
         self.optimizer.zero_grad()
         for layer, param in enumerate(self.model.parameters()):
-            param.grad.data = - weight_gradients[layer]
-            assert not np.isnan(param.grad.data).any()
-            assert not np.isinf(param.grad.data).any()
+            param.grad = - weight_gradients[layer].to(param.device)
+            self._check_finite(param.grad)
         if self.optimize_sigma:
-            self.beta.grad = - Variable(beta_gradients, requires_grad=True)
-            assert not np.isnan(self.beta.grad.data).any()
-            assert not np.isinf(self.beta.grad.data).any()
+            self.beta.grad = - beta_gradients
+            self._check_finite(self.beta.grad)
 
     def print_init(self):
         super(sES, self).print_init()
@@ -1535,49 +1779,35 @@ class sNES(sES):
         The gradients will point in the direction of change in the weights resulting in a
         decrease in the return.
         """
-        # CUDA
-        if self.cuda:
-            self.model.cuda()
-        
-        # Preallocate list with gradients
-        weight_gradients = []
-        for param in self.model.parameters():
-            weight_gradients.append(torch.zeros(param.data.size()))
+        # Compute gradients as products of the perturbation matrix and the (signed) returns
+        signed_returns, unsigned_returns = self._perturbation_returns(returns, seeds)
+        eps = self._perturbation_cache
         beta_gradients = torch.zeros(self.beta.size())
-
-        # Compute gradients
-        for i, retrn in enumerate(returns):
-            # Set random seed, get antithetic multiplier and return
-            sign = np.sign(seeds[i])
-            torch.manual_seed(abs(seeds[i]))
-            torch.cuda.manual_seed(abs(seeds[i]))
-            j = 0 
+        if self.optimize_sigma in [None, 'single']:
+            weight_gradients = self._weight_update_scale * self.sigma * eps.t().mv(signed_returns) / self.perturbations
+            if self.optimize_sigma == 'single':
+                beta_gradients += unsigned_returns.dot(eps.pow(2).sum(dim=1) - eps.size(1)) / self.perturbations
+        elif self.optimize_sigma == 'per-layer':
+            weight_gradients = torch.zeros(eps.size(1))
+            j = 0
             for layer, param in enumerate(self.model.parameters()):
-                eps = self.get_perturbation(param.size(), sensitivities=self.sensitivities[layer], cuda=self.cuda)
-                if not self.optimize_sigma:
-                    weight_gradients[layer] += self._weight_update_scale * self.sigma * (sign * retrn * eps) / self.perturbations
-                if self.optimize_sigma == 'single':
-                    weight_gradients[layer] += self._weight_update_scale * self.sigma * (sign * retrn * eps) / self.perturbations
-                    beta_gradients += retrn * (eps.pow(2).sum() - eps.numel()) / self.perturbations
-                elif self.optimize_sigma == 'per-layer':
-                    weight_gradients[layer] += self._weight_update_scale * self.sigma[layer] * (sign * retrn * eps) / self.perturbations
-                    beta_gradients[layer] += retrn * (eps.pow(2).sum() - eps.numel()) / self.perturbations
-                elif self.optimize_sigma == 'per-weight':
-                    k = j + param.numel()
-                    weight_gradients[layer] += self._weight_update_scale * self.sigma[j:k].view(weight_gradients[layer].size()) * (sign * retrn * eps) / self.perturbations
-                    beta_gradients[j:k] += retrn * (eps.view(-1).pow(2) - 1) / self.perturbations
-                    j = k
+                k = j + param.numel()
+                weight_gradients[j:k] = self._weight_update_scale * self.sigma[layer] * eps[:, j:k].t().mv(signed_returns) / self.perturbations
+                beta_gradients[layer] = unsigned_returns.dot(eps[:, j:k].pow(2).sum(dim=1) - param.numel()) / self.perturbations
+                j = k
+        elif self.optimize_sigma == 'per-weight':
+            weight_gradients = self._weight_update_scale * self.sigma * eps.t().mv(signed_returns) / self.perturbations
+            beta_gradients = (eps.pow(2).t().mv(unsigned_returns) - unsigned_returns.sum()) / self.perturbations
+        weight_gradients = self._vec2modelrepr(weight_gradients)
 
         # Set gradients
         self.optimizer.zero_grad()
         for layer, param in enumerate(self.model.parameters()):
-            param.grad.data = - weight_gradients[layer]
-            assert not np.isnan(param.grad.data).any()
-            assert not np.isinf(param.grad.data).any()
+            param.grad = - weight_gradients[layer].to(param.device)
+            self._check_finite(param.grad)
         if self.optimize_sigma:
-            self.beta.grad = - Variable(beta_gradients, requires_grad=True)
-            assert not np.isnan(self.beta.grad.data).any()
-            assert not np.isinf(self.beta.grad.data).any()
+            self.beta.grad = - beta_gradients
+            self._check_finite(self.beta.grad)
 
 
 class Backprop(Algorithm):
@@ -1594,7 +1824,6 @@ class Backprop(Algorithm):
             for batch_idx, (data, target) in enumerate(self.train_loader):
                 if self.cuda:
                     data, target = data.cuda(), target.cuda()
-                data, target = Variable(data), Variable(target)
                 self.optimizer.zero_grad()
                 output = self.model(data)
                 loss = F.nll_loss(output, target)
@@ -1614,14 +1843,14 @@ class Backprop(Algorithm):
         self.model.eval()
         test_loss = 0
         correct = 0
-        for data, target in self.test_loader:
-            if self.cuda:
-                data, target = data.cuda(), target.cuda()
-            data, target = Variable(data, volatile=True), Variable(target)
-            output = self.model(data)
-            test_loss += F.nll_loss(output, target, size_average=False).data[0] # sum up batch loss
-            pred = output.data.max(1, keepdim=True)[1] # get the index of the max log-probability
-            correct += pred.eq(target.data.view_as(pred)).cpu().sum()
+        with torch.no_grad():
+            for data, target in self.test_loader:
+                if self.cuda:
+                    data, target = data.cuda(), target.cuda()
+                output = self.model(data)
+                test_loss += F.nll_loss(output, target, reduction='sum').item() # sum up batch loss
+                pred = output.max(1, keepdim=True)[1] # get the index of the max log-probability
+                correct += pred.eq(target.view_as(pred)).cpu().sum()
 
         # test_loss /= len(self.test_loader.dataset)
         # print('\nTest set: Average loss: {:.4f}, Accuracy: {}/{} ({:.0f}%)\n'.format(
@@ -1652,9 +1881,9 @@ class xNES(StochasticGradientEstimation):
         A = torch.potrf(Sigma)
         # Compute scale: Compute the d'th root of the determinant of A
         self.sigma = np.abs(np.linalg.det(A.numpy())) ** (1 / self.d)
-        self.sigma = Variable(torch.Tensor([self.sigma]), requires_grad=True)
+        self.sigma = torch.Tensor([self.sigma]).requires_grad_()
         # Compute shape: Normalize cholesky factor of initial Sigma by scale
-        self.B = Variable(A/self.sigma.data, requires_grad=True)
+        self.B = (A / self.sigma.data).requires_grad_()
 
         # Find maximal number of elements in any model tensor
         m = 0
@@ -1701,11 +1930,8 @@ class xNES(StochasticGradientEstimation):
     #     return eps
 
     def perturb_model(self, seed):
-        # Get model class and instantiate new models as copies of parent
-        model_class = type(self.model)
-        perturbed_model = model_class(self.env.observation_space, self.env.action_space) if hasattr(self.env, 'observation_space') else model_class()
-        perturbed_model.load_state_dict(self.model.state_dict())
-        perturbed_model.zero_grad()
+        # Get the copy of the parent model of this process
+        perturbed_model = self._copy_model()
         # Handle antithetic sampling
         sign = np.sign(seed)
         # Set seed and permute by isotropic Gaussian noise
@@ -1730,8 +1956,7 @@ class xNES(StochasticGradientEstimation):
                 e = self.scale_by_sensitivities(e, s)
                 # print(e.mean(), e.std())
                 pp.data += e
-                assert not np.isnan(pp.data).any()
-                assert not np.isinf(pp.data).any()
+                self._check_finite(pp.data)
 
             # IPython.embed()
 
@@ -1777,8 +2002,7 @@ class xNES(StochasticGradientEstimation):
             # Permute each model parameter
             for pp, e in zip(perturbed_model.parameters(), eps):
                 pp.data += e
-                assert not np.isnan(p.data).any()
-                assert not np.isinf(p.data).any()
+                self._check_finite(pp.data)
         return perturbed_model
 
     def compute_gradients(self, returns, seeds):
@@ -1787,10 +2011,6 @@ class xNES(StochasticGradientEstimation):
         The gradients will point in the direction of change in the weights resulting in a
         decrease in the return.
         """
-        # CUDA
-        if self.cuda:
-            self.model.cuda()
-
         ## Indpendent parameter groups sampling
         # Preallocate list with gradients
         weight_gradients = []
@@ -1801,6 +2021,7 @@ class xNES(StochasticGradientEstimation):
         # Dependent parameter groups sampling (requires more memory)
         # Preallocate weight gradients as 1xn vector where n is number of parameters in model
         print("xNES compute gradients")
+        import IPython
         IPython.embed()
         delta_gradients = torch.zeros(self.model.count_parameters(only_trainable=True))
         M_gradients = torch.zeros(self.d, self.d)
@@ -1852,14 +2073,12 @@ class xNES(StochasticGradientEstimation):
         # Set gradients
         self.optimizer.zero_grad()
         for layer, param in enumerate(self.model.parameters()):
-            param.grad.data = - weight_gradients[layer]
-            assert not np.isnan(param.grad.data).any()
-            assert not np.isinf(param.grad.data).any()
+            param.grad = - weight_gradients[layer].to(param.device)
+            self._check_finite(param.grad)
         # TODO: For each parameter group in the optimizer that is not in the model, update the gradient
         if self.optimize_sigma:
             self.beta.grad = - beta_gradient
-            assert not np.isnan(self.beta.grad.data).any()
-            assert not np.isinf(self.beta.grad.data).any()
+            self._check_finite(self.beta.grad)
 
         # # Dependent parameter groups sampling (requires more memory)
         # # Preallocate weight gradients as 1xn vector where n is number of parameters in model
@@ -1898,12 +2117,14 @@ class GA(ES):
             start_generation = self.lr_scheduler.last_epoch + 1
             max_unperturbed_return = self._max_unp_return
         # Initialize variables independent of state
-        if self.workers > 1: pool = mp.Pool(processes=self.workers)
-        if self.track_parallel and "DISPLAY" in os.environ: pb = PoolProgress(pool, update_interval=.5, keep_after_done=False, title='Evaluating perturbations')
+        if self.workers > 1: pool = mp.Pool(processes=self.workers, initializer=_init_worker, initargs=(self.env, self.val_env))
+        pb = ProgressBar(keep_after_done=False, title='Evaluating perturbations') if self.track_parallel and "DISPLAY" in os.environ else None
         best_algorithm_stdct = None
         best_model_stdct = None
         best_optimizer_stdct = None
         last_checkpoint_time = time.time()
+        chkpt_executor = ThreadPoolExecutor(max_workers=1)
+        chkpt_job = None
         chunksize = self.perturbations // (10 * self.workers) + int(self.perturbations // (10 * self.workers) == 0)
         eval_kwargs = {'max_episode_length': self.batch_size, 'chunksize': chunksize}
         # eval_kwargs_unp = {'max_episode_length': self.batch_size, 'collect_inputs': hasattr(self.env, 'env'), 'chunksize': chunksize}
@@ -1915,62 +2136,74 @@ class GA(ES):
             self.sens_inputs = torch.from_numpy(unperturbed_out['inputs'])
 
         # Start training loop
-        for n_generation in range(start_generation, self.max_generations):
-            # Compute parent model weight-output sensitivities
-            self.compute_sensitivities()
+        try:
+            for n_generation in range(start_generation, self.max_generations):
+                # Compute parent model weight-output sensitivities
+                self.compute_sensitivities()
 
-            # Generate random seeds
-            seeds = torch.LongTensor(int(self.perturbations/((not self.no_antithetic) + 1))).random_()
-            if not self.no_antithetic: seeds = torch.cat([seeds, -seeds])
-            assert len(seeds) == self.perturbations, 'Number of created seeds is not equal to wanted perturbations'
+                # Generate random seeds
+                seeds = torch.LongTensor(int(self.perturbations/((not self.no_antithetic) + 1))).random_()
+                if not self.no_antithetic: seeds = torch.cat([seeds, -seeds])
+                assert len(seeds) == self.perturbations, 'Number of created seeds is not equal to wanted perturbations'
+
+                # Draw the perturbations of this generation
+                self.generate_perturbations(seeds)
             
-            workers_start_time = time.time()
-            if self.workers > 1:
-                # Execute all perturbations on the pool of processes
-                workers_out = pool.map_async(partial(self._eval_wrap, **eval_kwargs), seeds)
-                unperturbed_out = pool.apply_async(self.eval_fun, (self.model, self.env, 42), eval_kwargs_unp)
-                if self.track_parallel and "DISPLAY" in os.environ: pb.track(workers_out)
-                workers_out = workers_out.get(timeout=3600)
-                unperturbed_out = unperturbed_out.get(timeout=3600)
-            else:
-                # Execute sequentially
-                unperturbed_out = self.eval_fun(self.model, self.env, 42, **eval_kwargs_unp)
-                workers_out = []
-                for s in seeds:
-                    workers_out.append(self._eval_wrap(s, **eval_kwargs))
-            workers_time = time.time() - workers_start_time
-
-            assert 'return' in unperturbed_out.keys() and 'seed' in unperturbed_out.keys(), "The `eval_fun` must give a return and repass the used seed"
-            if hasattr(self.env, 'env'):
-                self.sens_inputs = torch.from_numpy(unperturbed_out['inputs'])
-            # Invert output from list of dicts to dict of lists
-            workers_out = dict(zip(workers_out[0], zip(*[d.values() for d in workers_out])))
-            # Recast all outputs as np.ndarrays except the seeds
-            for k, v in filter(lambda i: i[0] != 'seed', workers_out.items()): workers_out[k] = np.array(v)
+                # Evaluate perturbations
+                workers_start_time = time.time()
+                if self.workers > 1:
+                    # Share the parent model with the workers instead of copying it to each task
+                    self._share_with_workers()
+                    # Execute all perturbations on the pool of processes
+                    unperturbed_out = pool.apply_async(self._eval_unperturbed, kwds=eval_kwargs_unp)
+                    workers_out = self._collect(pool.imap_unordered(partial(self._eval_wrap, **eval_kwargs), seeds, chunksize=chunksize), len(seeds), pb)
+                    unperturbed_out = unperturbed_out.get(timeout=3600)
+                else:
+                    # Execute sequentially
+                    unperturbed_out = self.eval_fun(self.model, self.env, 42, **eval_kwargs_unp)
+                    workers_out = []
+                    for s in seeds:
+                        workers_out.append(self._eval_wrap(s, **eval_kwargs))
+                workers_time = time.time() - workers_start_time
+
+                assert 'return' in unperturbed_out.keys() and 'seed' in unperturbed_out.keys(), "The `eval_fun` must give a return and repass the used seed"
+                if hasattr(self.env, 'env'):
+                    self.sens_inputs = torch.from_numpy(unperturbed_out['inputs'])
+                # Invert output from list of dicts to dict of lists
+                workers_out = dict(zip(workers_out[0], zip(*[d.values() for d in workers_out])))
+                # Recast all outputs as np.ndarrays except the seeds
+                for k, v in filter(lambda i: i[0] != 'seed', workers_out.items()): workers_out[k] = np.array(v)
             
-            # Select best model (hillclimber)
-            best_idx = np.argmax(workers_out['return'])
-            best_seed = workers_out['seed'][best_idx]
-            self.model = self.perturb_model(best_seed)
-            rank = self.unperturbed_rank(workers_out['return'], unperturbed_out['return'])
-
-            # Keep track of best model
-            # TODO bm, bo, ba, mur = self.update_best(unperturbed_out['return'], mur)
-            # TODO Maybe not evaluate unperturbed model every iteration
-            if unperturbed_out['return'] >= max_unperturbed_return:
-                best_model_stdct = self.model.state_dict()
-                best_optimizer_stdct = self.optimizer.state_dict()
-                best_algorithm_stdct = self.state_dict(exclude=True)
-                max_unperturbed_return = unperturbed_out['return']
-
-            # Print and checkpoint
-            self._store_stats(workers_out, unperturbed_out, n_generation, rank, workers_time)
-            self.print_iter()
-            if last_checkpoint_time < time.time() - self.chkpt_int:
-                self.save_checkpoint(best_model_stdct, best_optimizer_stdct, best_algorithm_stdct)
-                plot_stats(os.path.join(self.chkpt_dir, 'stats.csv'), self.chkpt_dir)
-                last_checkpoint_time = time.time()
-        
+                # Select best model (hillclimber)
+                best_idx = np.argmax(workers_out['return'])
+                best_seed = workers_out['seed'][best_idx]
+                self.model.load_state_dict(self.perturb_model(best_seed).state_dict())
+                rank = self.unperturbed_rank(workers_out['return'], unperturbed_out['return'])
+
+                # Keep track of best model
+                # TODO bm, bo, ba, mur = self.update_best(unperturbed_out['return'], mur)
+                # TODO Maybe not evaluate unperturbed model every iteration
+                if unperturbed_out['return'] >= max_unperturbed_return:
+                    best_model_stdct = self.model.state_dict()
+                    best_optimizer_stdct = self.optimizer.state_dict()
+                    best_algorithm_stdct = self.state_dict(exclude=True)
+                    max_unperturbed_return = unperturbed_out['return']
+
+                # Print and checkpoint
+                self._store_stats(workers_out, unperturbed_out, n_generation, rank, workers_time)
+                self.print_iter()
+                if last_checkpoint_time < time.time() - self.chkpt_int:
+                    # Write in the background once the previous checkpoint is written
+                    if chkpt_job is not None:
+                        chkpt_job.result()
+                    chkpt_job = self.save_checkpoint(best_model_stdct, best_optimizer_stdct, best_algorithm_stdct, plot=True, executor=chkpt_executor)
+                    last_checkpoint_time = time.time()
+        finally:
+            # Wait for a checkpoint being written in the background, also when training is interrupted
+            if chkpt_job is not None:
+                chkpt_job.result()
+            chkpt_executor.shutdown(wait=True)
+
         # End training
         self.save_checkpoint(best_model_stdct, best_optimizer_stdct, best_algorithm_stdct)
         if self.workers > 1:
@@ -2050,71 +2283,6 @@ class GA(ES):
 #             assert not (p1.data == p2[0].data).all()
 #     return {'models': models, 'seeds': seeds}
 
-def execute_jobs(self, seeds):
-    """Start jobs as processes always keeping live processes to a minimum number 
-    by continuously ending dead processes
-    """
-    return_queue = mp.Queue()
-    chunksize = self.perturbations // (10 * self.workers) + int(self.perturbations // (10 * self.workers) == 0)
-    eval_kwargs = {'max_episode_length': self.batch_size, 'chunksize': chunksize, 'return_queue': return_queue}
-    eval_kwargs_unp = {'max_episode_length': self.batch_size, 'collect_inputs': hasattr(self.env, 'env') * self.batch_size, 'chunksize': chunksize, 'return_queue': return_queue}
-    processes = []
-    outputs = []
-    inputs = (self.model, self.env, 42)
-    submit_job(self.eval_fun, inputs, eval_kwargs_unp, processes)
-    for seed in seeds:
-        inputs = (self.perturb_model(seed), self.env, seed)
-        submit_job(self.eval_wrap, inputs, eval_kwargs, processes)
-        get_output(outputs, processes, return_queue)
-        outputs.append(out)
-
-def submit_job(fun, args, kwargs, processes):
-    p = mp.Process(target=fun, args=args, kwargs=kwargs)
-    p.start()
-    processes.append(p)
-
-def get_output(outputs, processes, return_queue):
-    # n_done = self.perturbations + 1 - sum([1 for p in processes if p.is_alive()])
-    if len(processes) > self.workers * 3:
-        pass
-    while not return_queue.empty():
-        raw_output.append(return_queue.get(False))
-    processes = [p for p in processes if p.is_alive()]
-    
-
-def start_jobs(self, models, seeds, return_queue):
-    processes = []
-    while models:
-        perturbed_model = models.pop()
-        seed = seeds.pop()
-        inputs = (perturbed_model, self.env, return_queue, seed)
-        try:
-            p = mp.Process(target=self.eval_fun, args=inputs, kwargs={'max_episode_length': self.batch_size})
-            p.start()
-            processes.append(p)
-        except (RuntimeError, BlockingIOError) as E:
-            IPython.embed()
-    assert len(seeds) == 0
-    # Evaluate the unperturbed model as well
-    inputs = (self.model.cpu(), self.env, return_queue, 'dummy_seed')
-    # TODO: Don't collect inputs during run, instead sample at start for sensitivities etc.
-    p = mp.Process(target=self.eval_fun, args=inputs, kwargs={'collect_inputs': 1000, 'max_episode_length': self.batch_size})
-    p.start()
-    processes.append(p)
-    return processes, return_queue
-
-def get_job_outputs(self, processes, return_queue):
-    raw_output = []
-    while processes:
-        # Update live processes
-        processes = [p for p in processes if p.is_alive()]
-        while not return_queue.empty():
-            raw_output.append(return_queue.get(False))
-    for p in processes:
-        p.join()
-    return raw_output
-
-
 # def get_perturbation_old(self, param=None, sensitivity=None, cuda=False):
 #     """This method computes a pertubation vector epsilon from a standard normal.
 
@@ -5,7 +5,6 @@ import pkgutil
 
 import atari_py
 import gym
-import IPython
 import numpy as np
 import torch
 from gym.spaces.box import Box
@@ -1,7 +1,6 @@
 import os
 import time
 
-import IPython
 import numpy as np
 import scipy.stats as st
 from sklearn.metrics import confusion_matrix
@@ -9,23 +8,22 @@ import gym
 
 import torch
 import torch.nn.functional as F
-from torch.autograd import Variable
 
 
 def get_action(actions, env):
     if type(env.action_space) is gym.spaces.Discrete:
         # Get index
-        action = actions.max(1)[1].data.numpy()[0]
+        action = actions.max(1)[1].item()
     elif type(env.action_space) is gym.spaces.Box:
         # Get values
-        action = actions.data.numpy().flatten()
+        action = actions.cpu().numpy().flatten()
         if np.prod(action.shape) == 1:
             # Index into array
             action = action[0]
     return action
 
 
-def gym_rollout(model, env, random_seed, mseed=None, silent=False, collect_inputs=False, do_cuda=False, max_episode_length=int(1e6), **kwargs):
+def gym_rollout(model, env, random_seed, mseed=None, silent=False, collect_inputs=False, max_episode_length=int(1e6), **kwargs):
     """
     Function to do rollouts of a policy defined by `model` in given environment
     """
@@ -37,7 +35,8 @@ def gym_rollout(model, env, random_seed, mseed=None, silent=False, collect_input
         # Random init
         env.seed(np.random.randint(0, 10**16))
     state = env.reset()
-    state = Variable(torch.from_numpy(state).float(), requires_grad=True).unsqueeze(0)
+    state = torch.from_numpy(state).float().unsqueeze(0)
+    device = next(model.parameters()).device
     retrn = 0
     n_observations = 0
     done = False
@@ -53,23 +52,21 @@ def gym_rollout(model, env, random_seed, mseed=None, silent=False, collect_input
         if collect_inputs and collect_inputs > n_observations:
             inputs[n_observations,] = state.data
         # Choose action
-        actions = model(state)
+        with torch.no_grad():
+            actions = model(state.to(device, non_blocking=True))
         action = get_action(actions, env)
         # Step
         state, reward, done, _ = env.step(action)
         retrn += reward
         n_observations += 1
         # Cast state
-        state = Variable(torch.from_numpy(state).float(), requires_grad=True).unsqueeze(0)
+        state = torch.from_numpy(state).float().unsqueeze(0)
     out = {'seed': random_seed, 'return': float(retrn), 'observations': n_observations}
     if collect_inputs:
         if collect_inputs is not True and n_observations < collect_inputs:
             # collect_inputs is a number and smaller than observations seens
             inputs = inputs[:n_observations,]
         out['inputs'] = inputs.numpy()
-    queue = kwargs.get('return_queue')
-    if queue:
-        queue.put(out)
     return out
 
 
@@ -81,21 +78,22 @@ def gym_render(model, env, max_episode_length):
         while True:
             # Reset environment
             state = env.reset()
-            state = Variable(torch.from_numpy(state).float(), volatile=True).unsqueeze(0)
+            state = torch.from_numpy(state).float().unsqueeze(0)
             this_model_return = 0
             this_model_num_steps = 0
             done = False
             # Rollout
             while not done and this_model_num_steps < max_episode_length:
                 # Choose action
-                actions = model(state)
+                with torch.no_grad():
+                    actions = model(state)
                 action = get_action(actions, env)
                 # Step
                 state, reward, done, _ = env.step(action)
                 this_model_return += reward
                 this_model_num_steps += 1
                 # Cast state
-                state = Variable(torch.from_numpy(state).float(), volatile=True).unsqueeze(0)
+                state = torch.from_numpy(state).float().unsqueeze(0)
                 env.render()
             print('Reward: %f' % this_model_return)
     except KeyboardInterrupt:
@@ -111,20 +109,21 @@ def gym_test(model, env, max_episode_length, n_episodes, chkpt_dir=None, **kwarg
         print('Episode {:d}/{:d}'.format(i_episode, n_episodes))
         # Reset environment
         state = env.reset()
-        state = Variable(torch.from_numpy(state).float(), volatile=True).unsqueeze(0)
+        state = torch.from_numpy(state).float().unsqueeze(0)
         this_model_num_steps = 0
         done = False
         # Rollout
         while not done and this_model_num_steps < max_episode_length:
             # Choose action
-            actions = model(state)
+            with torch.no_grad():
+                actions = model(state)
             action = get_action(actions, env)
             # Step
             state, reward, done, _ = env.step(action)
             returns[i_episode] += reward
             this_model_num_steps += 1
             # Cast state
-            state = Variable(torch.from_numpy(state).float(), volatile=True).unsqueeze(0)
+            state = torch.from_numpy(state).float().unsqueeze(0)
     
     mean = np.mean(returns)  # Mean return
     sem = st.sem(returns)    # Standard error of mean
@@ -140,7 +139,7 @@ def gym_test(model, env, max_episode_length, n_episodes, chkpt_dir=None, **kwarg
     print(s)
 
 
-def supervised_eval(model, train_loader, random_seed, mseed=None, silent=False, collect_inputs=False, do_cuda=False, **kwargs):
+def supervised_eval(model, train_loader, random_seed, mseed=None, silent=False, collect_inputs=False, **kwargs):
     """
     Function to evaluate the fitness of a supervised model.
 
@@ -154,19 +153,17 @@ def supervised_eval(model, train_loader, random_seed, mseed=None, silent=False,
     else:
         # Sample unique batch
         (data, target) = next(iter(train_loader))
-    data, target = Variable(data), Variable(target)
-    if do_cuda:
-        data, target = data.cuda(), target.cuda()
-    output = model(data)
-    retrn = -F.nll_loss(output, target)
-    if do_cuda:
-        retrn = retrn.cpu()
-    retrn = retrn.data.numpy()[0]
-    pred = output.data.max(1, keepdim=True)[1]  # get the index of the max log-probability
-    accuracy = pred.eq(target.data.view_as(pred)).sum()/target.data.size()[0]
-    out = {'seed': random_seed, 'return': retrn, 'observations': data.data.size()[0], 'accuracy': accuracy}
+    # Move the batch to the device of the model unless the loader already did
+    device = next(model.parameters()).device
+    data, target = data.to(device, non_blocking=True), target.to(device, non_blocking=True)
+    with torch.no_grad():
+        output = model(data)
+        retrn = -F.nll_loss(output, target).item()
+        pred = output.max(1)[1]  # get the index of the max log-probability
+        accuracy = pred.eq(target).float().mean().item()
+    out = {'seed': random_seed, 'return': retrn, 'observations': data.size()[0], 'accuracy': accuracy}
     if collect_inputs:
-        # NOTE It is necessary to convert the torch.autograd.Variable to numpy array 
+        # NOTE It is necessary to convert the torch.Tensor to numpy array 
         # in order to correctly transfer this data from the worker thread to the main thread.
         # This is an unfortunate result of how Python pickling handles sending file descriptors.
         # Torch sends tensors via shared memory instead of writing the values to the queue. 
@@ -174,35 +171,60 @@ def supervised_eval(model, train_loader, random_seed, mseed=None, silent=False,
         #   1. Background process sends token mp.Queue.
         #   2. When the main process reads the token, it opens a unix socket to the background process.
         #   3. The background process sends the file descriptor via the unix socket.
-        out['inputs'] = data.data.numpy()
+        out['inputs'] = data.cpu().numpy()
         # Also print correct prediction ratio
-    queue = kwargs.get('return_queue')
-    if queue:
-        queue.put(out)
     return out
 
 
-def supervised_test(model, test_loader, cuda=False, chkpt_dir=None):
+def supervised_eval_batched(model, parameters, train_loader, random_seeds, mseed=None, **kwargs):
+    """
+    Function to evaluate the fitness of many parameter settings of a supervised model at once.
+
+    The parameters are given as a dict of tensors named as the parameters of the model and
+    with one parameter setting per entry along the first dimension. All settings are evaluated
+    on the same batch in a single forward pass vectorized over the settings.
+    """
+    if mseed is not None:
+        # Use common random numbers
+        torch.manual_seed(mseed)
+    (data, target) = next(iter(train_loader))
+    # Move the batch to the device of the parameters unless the loader already did
+    device = next(iter(parameters.values())).device
+    data, target = data.to(device, non_blocking=True), target.to(device, non_blocking=True)
+    with torch.no_grad():
+        outputs = model.batched_forward(data, parameters)
+        targets = target.expand(outputs.size(0), -1)
+        returns = outputs.gather(2, targets.unsqueeze(2)).squeeze(2).mean(dim=1)
+        accuracies = outputs.max(2)[1].eq(targets).float().mean(dim=1)
+    return [{'seed': s, 'return': r, 'observations': data.size()[0], 'accuracy': a}
+            for s, r, a in zip(random_seeds, returns.tolist(), accuracies.tolist())]
+
+
+def supervised_test(model, test_loader, chkpt_dir=None):
     """
     Function to test the performance of a supervised classification model
     """
     model.eval()
-    test_loss = 0
-    correct = 0
+    # Accumulate on the device of the model and only synchronize once all batches are evaluated
+    device = next(model.parameters()).device
+    test_loss = torch.zeros((), device=device)
+    correct = torch.zeros((), dtype=torch.long, device=device)
     predictions = []
     targets = []
-    for data, target in test_loader:
-        if cuda:
-            data, target = data.cuda(), target.cuda()
-        data, target = Variable(data, volatile=True), Variable(target)
-        output = model(data)
-        test_loss += F.nll_loss(output, target, size_average=False).data[0] # sum up batch loss
-        pred = output.data.max(1, keepdim=True)[1] # get the index of the max log-probability
-        correct += pred.eq(target.data.view_as(pred)).cpu().sum()
-        predictions.extend(pred.cpu().numpy().flatten())
-        targets.extend(target.cpu().data.numpy().flatten())
-
-    test_loss /= len(test_loader.dataset)
+    with torch.no_grad():
+        for data, target in test_loader:
+            data, target = data.to(device, non_blocking=True), target.to(device, non_blocking=True)
+            output = model(data)
+            test_loss += F.nll_loss(output, target, reduction='sum') # sum up batch loss
+            pred = output.max(1)[1] # get the index of the max log-probability
+            correct += pred.eq(target).sum()
+            predictions.append(pred)
+            targets.append(target)
+    predictions = torch.cat(predictions).cpu().numpy()
+    targets = torch.cat(targets).cpu().numpy()
+    correct = correct.item()
+
+    test_loss = test_loss.item() / len(test_loader.dataset)
     s = 'Average loss: {:.4f}, Accuracy: {}/{} ({:.0f}%)\n\n'.format(
         test_loss, correct, len(test_loader.dataset),
         100. * correct / len(test_loader.dataset))
@@ -1,54 +1,50 @@
-from functools import partial
-from itertools import chain, islice, tee
+import math
+import types
+from functools import lru_cache
 
 import gym
-import IPython
 import numpy as np
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
-from torch.autograd import Variable
+from torch.func import functional_call, vmap
 from torch.nn.modules.module import _addindent
+from torch.nn.utils.fusion import fuse_conv_bn_eval, fuse_linear_bn_eval
 
 from context import utils
 from utils.torchutils import summarize_model, calculate_xavier_gain
 
 
 def model_weight_initializer(model):
-    def current_and_next(some_iterable):
-        items, nexts = tee(some_iterable)
-        nexts = chain(islice(nexts, 1, None), [None])
-        return zip(items, nexts)
-
-    def previous_and_next(some_iterable):
-        prevs, items, nexts = tee(some_iterable, 3)
-        prevs = chain([None], prevs)
-        nexts = chain(islice(nexts, 1, None), [None])
-        return zip(prevs, items, nexts)
-    
-    for module, next_module in current_and_next(model.modules()):
-        IPython.embed()
-        try:
-            gain = nn.init.calculate_gain(next_module)
-        except:
-            continue
-        if isinstance(module, nn.Conv2d):
-            n = module.kernel_size[0] * module.kernel_size[1] * module.out_channels
-            module.weight.data.normal_(0, np.sqrt(2. / n))
-            if module.bias is not None:
-                module.bias.data.zero_()
-        elif isinstance(module, nn.BatchNorm2d):
-            module.weight.data.fill_(1)
-            module.bias.data.zero_()
-        elif isinstance(module, nn.Linear):
-            module.weight.data.normal_(0, 0.01)
-            module.bias.data.zero_()
-        
-
-def capsule_softmax(input, dim=1):
-    transposed_input = input.transpose(dim, len(input.size()) - 1)
-    softmaxed_output = F.softmax(transposed_input.contiguous().view(-1, transposed_input.size(-1)))
-    return softmaxed_output.view(*transposed_input.size()).transpose(dim, len(input.size()) - 1)
+    for m in model.modules():
+        if isinstance(m, nn.Conv2d):
+            nn.init.kaiming_normal_(m.weight, mode='fan_out', nonlinearity='relu')
+            if m.bias is not None:
+                nn.init.zeros_(m.bias)
+        elif isinstance(m, nn.BatchNorm2d):
+            nn.init.ones_(m.weight)
+            nn.init.zeros_(m.bias)
+        elif isinstance(m, nn.Linear):
+            nn.init.normal_(m.weight, 0, 0.01)
+            if m.bias is not None:
+                nn.init.zeros_(m.bias)
+
+
+@lru_cache(maxsize=None)
+def conv_output_shape(in_shape, convs):
+    """Computes the output shape of a stack of 2D convolutions analytically.
+
+    Args:
+        in_shape (tuple): Shape of the input as (channels, height, width)
+        convs (tuple): A (out_channels, kernel_size, stride, padding, dilation) tuple per convolution with pairs for the spatial arguments
+
+    Returns:
+        tuple: Shape of the output as (channels, height, width)
+    """
+    channels, size = in_shape[0], tuple(in_shape[1:])
+    for channels, kernel_size, stride, padding, dilation in convs:
+        size = tuple((s + 2 * p - d * (k - 1) - 1) // st + 1 for s, k, st, p, d in zip(size, kernel_size, stride, padding, dilation))
+    return (channels, *size)
 
 
 class IdentityFunction(nn.Module):
@@ -65,23 +61,53 @@ class AbstractESModel(nn.Module):
     """Abstract models class for models that are trained by evolutionary methods.
     It has methods for counting parameters, layers and tensors.
     """
-    
+
+    def compile_forward(self, mode='reduce-overhead'):
+        """Compiles the forward pass of the model with `torch.compile`.
+
+        Copies of the model made by pickling or deep copying keep the compile mode but run 
+        their forward pass uncompiled until `compile_forward` is called on them. The workers 
+        compile the single perturbed model they reuse for all evaluations once.
+        """
+        self._compile_mode = mode
+        self.forward = torch.compile(types.MethodType(type(self).forward, self), mode=mode)
+        return self
+
+    def batched_forward(self, x, parameters, batched_inputs=False):
+        """Evaluates the model with several settings of its parameters in a single vectorized forward pass.
+
+        Args:
+            x (torch.Tensor): Inputs shared by all settings or, if `batched_inputs`, inputs of each setting stacked along the first dimension
+            parameters (dict): Tensors named as the parameters of the model with the settings stacked along the first dimension
+            batched_inputs (bool, optional): Defaults to False. Denotes whether `x` holds separate inputs for each setting
+
+        Returns:
+            torch.Tensor: The outputs of each setting stacked along the first dimension
+        """
+        def forward(parameters, x):
+            return functional_call(self, parameters, (x,))
+        return vmap(forward, in_dims=(0, 0 if batched_inputs else None), randomness='different')(parameters, x)
+
+    def __getstate__(self):
+        state = super(AbstractESModel, self).__getstate__()
+        state.pop('forward', None)
+        return state
+
+
     def parameter_norm(self):
         parameter_norm = 0
         for p in self.parameters():
-            parameter_norm += (p.data.view(-1) @ p.data.view(-1))
-        parameter_norm = np.sqrt(parameter_norm)
-        return parameter_norm
+            parameter_norm += (p.data.reshape(-1) @ p.data.reshape(-1))
+        # Reduce with torch since the parameters may be on the GPU
+        return torch.sqrt(parameter_norm).item()
 
     def gradient_norm(self):
         gradient_norm = 0
         for p in self.parameters():
             if p.grad is None:
-                gradient_norm = None
-                break
-            gradient_norm += (p.grad.data.view(-1) @ p.grad.data.view(-1))
-        gradient_norm = np.sqrt(gradient_norm)
-        return gradient_norm
+                return None
+            gradient_norm += (p.grad.data.reshape(-1) @ p.grad.data.reshape(-1))
+        return torch.sqrt(gradient_norm).item()
     
     @property
     def summary(self):
@@ -89,6 +115,25 @@ class AbstractESModel(nn.Module):
             self._summary = summarize_model(self, self.in_dim)
         return self._summary
 
+    @property
+    def summary_counts(self):
+        if not hasattr(self, '_summary_counts'):
+            self._summary_counts = self._compute_summary_counts(self.summary)
+        return self._summary_counts
+
+    @staticmethod
+    def _compute_summary_counts(summary):
+        """Compute the [trainable] parameter, tensor and layer counts of a model summary once.
+        """
+        n_tensors = summary['weight_shapes'].map(len)
+        counts = {}
+        for only_trainable, k in [(True, 'n_trainable'), (False, 'n_parameters')]:
+            has_parameters = summary[k] > 0
+            counts[('parameters', only_trainable)] = int(summary[k].sum())
+            counts[('tensors', only_trainable)] = int(n_tensors[has_parameters].sum())
+            counts[('layers', only_trainable)] = int(has_parameters.sum())
+        return counts
+
     def count_parameters(self, only_trainable=True):
         """Return the number of [trainable] parameters in this model.
         """
@@ -98,8 +143,7 @@ class AbstractESModel(nn.Module):
     def _count_parameters(m, only_trainable=True):
         """Count the number of [trainable] parameters in a pytorch model.
         """
-        k = 'n_trainable' if only_trainable else 'n_parameters'
-        return int(m.summary[k].sum())
+        return m.summary_counts[('parameters', only_trainable)]
 
     def count_tensors(self, only_trainable=True):
         return self._count_tensors(self, only_trainable=only_trainable)
@@ -108,8 +152,7 @@ class AbstractESModel(nn.Module):
     def _count_tensors(m, only_trainable=True):
         """Count the number of [trainable] tensor objects in a pytorch model.
         """
-        k = 'n_trainable' if only_trainable else 'n_parameters'
-        return sum([1 for i, l in m.summary.iterrows() for w in l['weight_shapes'] if l['weight_shapes'] and l[k] > 0])
+        return m.summary_counts[('tensors', only_trainable)]
 
     def count_layers(self, only_trainable=True):
         """Count the number of [trainable] layers in a pytorch model.
@@ -119,8 +162,7 @@ class AbstractESModel(nn.Module):
     
     @staticmethod
     def _count_layers(m, only_trainable=True):
-        k = 'n_trainable' if only_trainable else 'n_parameters'
-        return m.summary[m.summary[k] > 0].shape[0]
+        return m.summary_counts[('layers', only_trainable)]
 
     def _initialize_weights(self):
         # Loop in reverse to pick up the nonlinearity following the layer for gain computation
@@ -132,17 +174,17 @@ class AbstractESModel(nn.Module):
                 gain = 1
             if isinstance(m, nn.Conv1d) or isinstance(m, nn.Conv2d) or isinstance(m, nn.Conv3d):
                 assert gain == calculate_xavier_gain(nn.Conv1d)
-                nn.init.xavier_normal(m.weight.data, gain=gain)
+                nn.init.xavier_normal_(m.weight, gain=gain)
                 if m.bias is not None:
-                    m.bias.data.zero_()
+                    nn.init.zeros_(m.bias)
             elif isinstance(m, nn.Linear):
                 assert gain == calculate_xavier_gain(nn.Linear)
-                nn.init.xavier_normal(m.weight.data, gain=gain)
+                nn.init.xavier_normal_(m.weight, gain=gain)
             elif isinstance(m, nn.BatchNorm1d) or isinstance(m, nn.BatchNorm2d) or isinstance(m, nn.BatchNorm3d):
                 if m.affine:
                     # Affine transform does nothing at first
-                    m.weight.data.fill_(1)
-                    m.bias.data.zero_()
+                    nn.init.ones_(m.weight)
+                    nn.init.zeros_(m.bias)
                 # if m.track_running_stats:
                 # Running stats are initialized to have no history
                 m.running_mean.zero_()
@@ -151,22 +193,29 @@ class AbstractESModel(nn.Module):
 
 def transform_range(in_value, in_maxs, in_mins, out_maxs, out_mins):
     """Transform a number from a range into another range, maintaining ratios.
+
+    The transformation is computed as an affine scale and offset into a single new array.
     """
     assert (in_value <= in_maxs).all() and (in_value >= in_mins).all()
-    in_range = (in_maxs - in_mins)  
-    out_range = (out_maxs - out_mins)  
-    return (((in_value - in_mins) * out_range) / in_range) + out_mins
+    scale = (out_maxs - out_mins) / (in_maxs - in_mins)
+    out = np.multiply(in_value, scale)
+    out += out_mins - in_mins * scale
+    return out
+
 
+class SigmoidAffine(nn.Module):
+    """Applies the element wise sigmoid function followed by an affine transformation and views the output as `view_dim`.
 
-def apply_sigmoid_and_transform(x, **kwargs):
-    """Applies the element wise sigmoid function and transforms output into a given range
+    The scale and bias are constant and computed once at construction.
     """
-    view_dim = kwargs.pop('view_dim')
-    a = nn.Sigmoid()
-    y = a(x)
-    # y.data = torch.from_numpy(transform_range(y.data.numpy(), **kwargs))
-    y = y.view(view_dim)
-    return y
+    def __init__(self, view_dim, scale=1.0, bias=0.0):
+        super(SigmoidAffine, self).__init__()
+        self.view_dim = view_dim
+        self.register_buffer('scale', torch.as_tensor(scale, dtype=torch.float32), persistent=False)
+        self.register_buffer('bias', torch.as_tensor(bias, dtype=torch.float32), persistent=False)
+
+    def forward(self, x):
+        return torch.addcmul(self.bias, torch.sigmoid(x), self.scale).view(self.view_dim)
 
 
 class ClassicalControlFNN(AbstractESModel):
@@ -179,13 +228,9 @@ class ClassicalControlFNN(AbstractESModel):
             # Continuous action space:
             # Physical output to be used directly.
             self.out_dim = action_space.shape
-            self.n_out = int(np.prod(action_space.shape))
-            out_mins = action_space.low if not np.isinf(action_space.low).any() else - np.ones(action_space.shape)
-            out_maxs = action_space.high if not np.isinf(action_space.high).any() else np.ones(action_space.shape)
-            sigmoid_mins = - np.ones(out_mins.shape)
-            sigmoid_maxs = np.ones(out_maxs.shape)
-            trsf_in = {'view_dim': (-1, *self.out_dim), 'in_maxs': sigmoid_maxs, 'in_mins': sigmoid_mins, 'out_maxs': out_maxs, 'out_mins': out_mins}
-            self.out_activation = partial(apply_sigmoid_and_transform, **trsf_in)
+            self.n_out = math.prod(action_space.shape)
+            # The output is currently not transformed into the range of the action space (infinite bounds should be taken as -1 and 1)
+            self.out_activation = SigmoidAffine((-1, *self.out_dim))
         elif type(action_space) is gym.spaces.Discrete:
             # Discrete action space: 
             # Probabilistic output to be indexed by maximum probability.
@@ -193,33 +238,30 @@ class ClassicalControlFNN(AbstractESModel):
             self.n_out = action_space.n
             self.out_activation = nn.LogSoftmax(dim=1)
         elif type(action_space) is gym.spaces.MultiDiscrete:
-            IPython.embed()
-            pass
+            raise NotImplementedError('MultiDiscrete action spaces are not yet supported')
         elif type(action_space) is gym.spaces.MultiBinary:
-            IPython.embed()
-            pass
-        elif type(action_space) is gym.spaces.tuple:
+            raise NotImplementedError('MultiBinary action spaces are not yet supported')
+        elif type(action_space) is gym.spaces.Tuple:
             # Tuple of different action spaces
             # https://github.com/openai/gym/blob/master/gym/envs/algorithmic/algorithmic_env.py
-            IPython.embed()
-            pass
+            raise NotImplementedError('Tuple action spaces are not yet supported')
 
         assert hasattr(observation_space, 'shape') and len(observation_space.shape) == 1
         assert hasattr(action_space, 'shape')
         self.in_dim = observation_space.shape
-        self.n_in = int(np.prod(observation_space.shape))
+        self.n_in = math.prod(observation_space.shape)
         self.lin1 = nn.Linear(self.n_in, 32)
-        self.relu1 = nn.ReLU()
+        self.relu1 = nn.ReLU(inplace=True)
         self.lin2 = nn.Linear(32, 64)
-        self.relu2 = nn.ReLU()
+        self.relu2 = nn.ReLU(inplace=True)
         self.lin3 = nn.Linear(64, 128)
-        self.relu3 = nn.ReLU()
+        self.relu3 = nn.ReLU(inplace=True)
         self.lin4 = nn.Linear(128, 128)
-        self.relu4 = nn.ReLU()
+        self.relu4 = nn.ReLU(inplace=True)
         self.lin5 = nn.Linear(128, 64)
-        self.relu5 = nn.ReLU()
+        self.relu5 = nn.ReLU(inplace=True)
         self.lin6 = nn.Linear(64, 32)
-        self.relu6 = nn.ReLU()
+        self.relu6 = nn.ReLU(inplace=True)
         self.lin7 = nn.Linear(32, self.n_out)
         self._initialize_weights()
 
@@ -244,13 +286,9 @@ class ClassicalControlRNN(AbstractESModel):
             # Continuous action space:
             # Physical output to be used directly.
             self.out_dim = action_space.shape
-            self.n_out = int(np.prod(action_space.shape))
-            out_mins = action_space.low if not np.isinf(action_space.low).any() else - np.ones(action_space.shape)
-            out_maxs = action_space.high if not np.isinf(action_space.high).any() else np.ones(action_space.shape)
-            sigmoid_mins = - np.ones(out_mins.shape)
-            sigmoid_maxs = np.ones(out_maxs.shape)
-            trsf_in = {'view_dim': (-1, *self.out_dim), 'in_maxs': sigmoid_maxs, 'in_mins': sigmoid_mins, 'out_maxs': out_maxs, 'out_mins': out_mins}
-            self.out_activation = partial(apply_sigmoid_and_transform, **trsf_in)
+            self.n_out = math.prod(action_space.shape)
+            # The output is currently not transformed into the range of the action space (infinite bounds should be taken as -1 and 1)
+            self.out_activation = SigmoidAffine((-1, *self.out_dim))
         elif type(action_space) is gym.spaces.Discrete:
             # Discrete action space: 
             # Probabilistic output to be indexed by maximum probability.
@@ -261,15 +299,15 @@ class ClassicalControlRNN(AbstractESModel):
         assert hasattr(observation_space, 'shape') and len(observation_space.shape) == 1
         assert hasattr(action_space, 'shape')
         
-        self.n_in = int(np.prod(observation_space.shape))
+        self.n_in = math.prod(observation_space.shape)
         self.lin1 = nn.Linear(self.n_in, 32)
-        self.relu1 = nn.ReLU()
+        self.relu1 = nn.ReLU(inplace=True)
         self.lin2 = nn.Linear(32, 64)
-        self.relu2 = nn.ReLU()
+        self.relu2 = nn.ReLU(inplace=True)
         self.lin3 = nn.Linear(64, 64)
-        self.relu3 = nn.ReLU()
+        self.relu3 = nn.ReLU(inplace=True)
         self.lin4 = nn.Linear(64, 32)
-        self.relu4 = nn.ReLU()
+        self.relu4 = nn.ReLU(inplace=True)
         self.lin5 = nn.Linear(32, self.n_out)
         self._initialize_weights()
 
@@ -292,13 +330,9 @@ class MujocoFNN(AbstractESModel):
             # Continuous action space:
             # Physical output to be used directly.
             self.out_dim = action_space.shape
-            self.n_out = int(np.prod(action_space.shape))
-            out_mins = action_space.low if not np.isinf(action_space.low).any() else - np.ones(action_space.shape)
-            out_maxs = action_space.high if not np.isinf(action_space.high).any() else np.ones(action_space.shape)
-            sigmoid_mins = - np.ones(out_mins.shape)
-            sigmoid_maxs = np.ones(out_maxs.shape)
-            trsf_in = {'view_dim': (-1, *self.out_dim), 'in_maxs': sigmoid_maxs, 'in_mins': sigmoid_mins, 'out_maxs': out_maxs, 'out_mins': out_mins}
-            self.out_activation = partial(apply_sigmoid_and_transform, **trsf_in)
+            self.n_out = math.prod(action_space.shape)
+            # The output is currently not transformed into the range of the action space (infinite bounds should be taken as -1 and 1)
+            self.out_activation = SigmoidAffine((-1, *self.out_dim))
         elif type(action_space) is gym.spaces.Discrete:
             # Discrete action space: 
             # Probabilistic output to be indexed by maximum probability.
@@ -306,33 +340,30 @@ class MujocoFNN(AbstractESModel):
             self.n_out = action_space.n
             self.out_activation = nn.LogSoftmax(dim=1)
         elif type(action_space) is gym.spaces.MultiDiscrete:
-            IPython.embed()
-            pass
+            raise NotImplementedError('MultiDiscrete action spaces are not yet supported')
         elif type(action_space) is gym.spaces.MultiBinary:
-            IPython.embed()
-            pass
-        elif type(action_space) is gym.spaces.tuple:
+            raise NotImplementedError('MultiBinary action spaces are not yet supported')
+        elif type(action_space) is gym.spaces.Tuple:
             # Tuple of different action spaces
             # https://github.com/openai/gym/blob/master/gym/envs/algorithmic/algorithmic_env.py
-            IPython.embed()
-            pass
+            raise NotImplementedError('Tuple action spaces are not yet supported')
 
         assert hasattr(observation_space, 'shape') and len(observation_space.shape) == 1
         assert hasattr(action_space, 'shape')
         self.in_dim = observation_space.shape
-        self.n_in = int(np.prod(observation_space.shape))
+        self.n_in = math.prod(observation_space.shape)
         self.lin1 = nn.Linear(self.n_in, 512)
-        self.relu1 = nn.ReLU()
+        self.relu1 = nn.ReLU(inplace=True)
         self.lin2 = nn.Linear(512, 1024)
-        self.relu2 = nn.ReLU()
+        self.relu2 = nn.ReLU(inplace=True)
         self.lin3 = nn.Linear(1024, 1024)
-        self.relu3 = nn.ReLU()
+        self.relu3 = nn.ReLU(inplace=True)
         self.lin4 = nn.Linear(1024, 512)
-        self.relu4 = nn.ReLU()
+        self.relu4 = nn.ReLU(inplace=True)
         self.lin5 = nn.Linear(512, 256)
-        self.relu5 = nn.ReLU()
+        self.relu5 = nn.ReLU(inplace=True)
         self.lin6 = nn.Linear(256, 128)
-        self.relu6 = nn.ReLU()
+        self.relu6 = nn.ReLU(inplace=True)
         self.lin7 = nn.Linear(128, self.n_out)
         self._initialize_weights()
 
@@ -358,14 +389,14 @@ class DQN(AbstractESModel):
         in_channels = observation_space.shape[0]
         out_dim = action_space.n
         self.conv1 = nn.Conv2d(in_channels, out_channels=32, kernel_size=(8, 8), stride=(4, 4))
-        self.conv1_relu = nn.ReLU()
+        self.conv1_relu = nn.ReLU(inplace=True)
         self.conv2 = nn.Conv2d(32, out_channels=64, kernel_size=(4, 4), stride=(2, 2))
-        self.conv2_relu = nn.ReLU()
+        self.conv2_relu = nn.ReLU(inplace=True)
         self.conv3 = nn.Conv2d(64, out_channels=64, kernel_size=(3, 3), stride=(1, 1))
-        self.conv3_relu = nn.ReLU()
+        self.conv3_relu = nn.ReLU(inplace=True)
         n_size = self._get_conv_output(observation_space.shape)
         self.lin1 = nn.Linear(n_size, 512)
-        self.lin1_relu = nn.ReLU()
+        self.lin1_relu = nn.ReLU(inplace=True)
         self.lin2 = nn.Linear(512, out_dim)
         self.lin2_logsoftmax = nn.LogSoftmax(dim=1)
         self._initialize_weights()
@@ -378,13 +409,10 @@ class DQN(AbstractESModel):
         return x
 
     def _get_conv_output(self, shape):
-        """Compute the number of output parameters from convolutional part by forward pass
+        """Compute the number of output parameters from convolutional part
         """
-        bs = 1
-        inputs = Variable(torch.rand(bs, *shape))
-        output_feat = self._forward_features(inputs)
-        n_size = output_feat.data.view(bs, -1).size(1)
-        return n_size
+        convs = tuple((c.out_channels, c.kernel_size, c.stride, c.padding, c.dilation) for c in [self.conv1, self.conv2, self.conv3])
+        return math.prod(conv_output_shape(tuple(shape), convs))
 
     def _forward_features(self, x):
         x = self.conv1_relu(self.conv1(x))
@@ -406,16 +434,16 @@ class MNISTNet(AbstractESModel):
         self.conv1 = nn.Conv2d(1, 10, kernel_size=(5, 5))
         self.conv1_bn = nn.BatchNorm2d(10)
         self.conv1_pool = nn.MaxPool2d(kernel_size=(2, 2), stride=None, padding=0, dilation=1, return_indices=False, ceil_mode=False)
-        self.conv1_relu = nn.ReLU()
+        self.conv1_relu = nn.ReLU(inplace=True)
 
         self.conv2 = nn.Conv2d(10, 20, kernel_size=(5, 5))
         self.conv2_bn = nn.BatchNorm2d(20)
         self.conv2_pool = nn.MaxPool2d(kernel_size=(2, 2), stride=None, padding=0, dilation=1, return_indices=False, ceil_mode=False)
-        self.conv2_relu = nn.ReLU()
+        self.conv2_relu = nn.ReLU(inplace=True)
 
         self.fc1 = nn.Linear(320, 50)
         self.fc1_bn = nn.BatchNorm1d(50)
-        self.fc1_relu = nn.ReLU()
+        self.fc1_relu = nn.ReLU(inplace=True)
 
         self.fc2 = nn.Linear(50, 10)
         self.fc2_logsoftmax = nn.LogSoftmax(dim=1)
@@ -425,11 +453,29 @@ class MNISTNet(AbstractESModel):
     def forward(self, x):
         x = self.conv1_relu(self.conv1_pool(self.conv1_bn(self.conv1(x))))
         x = self.conv2_relu(self.conv2_pool(self.conv2_bn(self.conv2(x))))
-        x = x.view(-1, 320)
+        x = x.reshape(-1, 320)
         x = self.fc1_relu(self.fc1_bn(self.fc1(x)))
         x = self.fc2_logsoftmax(self.fc2(x))
         return x
 
+    def fuse_for_eval(self):
+        """Folds the batch normalizations into the preceding convolutional and linear layers.
+
+        The fused model computes the same outputs as the unfused model in evaluation mode but
+        can no longer be trained, so this should only be called once training is done.
+        """
+        assert not self.training, "Batch normalization can only be fused in evaluation mode"
+        self.conv1 = fuse_conv_bn_eval(self.conv1, self.conv1_bn)
+        self.conv1_bn = nn.Identity()
+        self.conv2 = fuse_conv_bn_eval(self.conv2, self.conv2_bn)
+        self.conv2_bn = nn.Identity()
+        self.fc1 = fuse_linear_bn_eval(self.fc1, self.fc1_bn)
+        self.fc1_bn = nn.Identity()
+        # The summary describes the unfused layers
+        self.__dict__.pop('_summary', None)
+        self.__dict__.pop('_summary_counts', None)
+        return self
+
 
 class MNISTNetDropout(AbstractESModel):
     """ 
@@ -443,15 +489,15 @@ class MNISTNetDropout(AbstractESModel):
         self.in_dim = torch.Size((1, 28, 28))
         self.conv1 = nn.Conv2d(1, 10, kernel_size=(5, 5))
         self.conv1_pool = nn.MaxPool2d(kernel_size=(2, 2), stride=None, padding=0, dilation=1, return_indices=False, ceil_mode=False)
-        self.conv1_relu = nn.ReLU()
+        self.conv1_relu = nn.ReLU(inplace=True)
 
         self.conv2 = nn.Conv2d(10, 20, kernel_size=(5, 5))
         self.conv2_pool = nn.MaxPool2d(kernel_size=(2, 2), stride=None, padding=0, dilation=1, return_indices=False, ceil_mode=False)
-        self.conv2_relu = nn.ReLU()
+        self.conv2_relu = nn.ReLU(inplace=True)
         self.conv2_dropout = nn.Dropout2d(p=0.2)
 
         self.fc1 = nn.Linear(320, 50)
-        self.fc1_relu = nn.ReLU()
+        self.fc1_relu = nn.ReLU(inplace=True)
         self.fc1_dropout = nn.Dropout(p=0.5)
 
         self.fc2 = nn.Linear(50, 10)
@@ -462,7 +508,7 @@ class MNISTNetDropout(AbstractESModel):
     def forward(self, x):
         x = self.conv1_relu(self.conv1_pool(self.conv1(x)))
         x = self.conv2_dropout(self.conv2_relu(self.conv2_pool(self.conv2(x))))
-        x = x.view(-1, 320)
+        x = x.reshape(-1, 320)
         x = self.fc1_dropout(self.fc1_relu(self.fc1(x)))
         x = self.fc2_logsoftmax(self.fc2(x))
         return x
@@ -476,14 +522,14 @@ class MNISTNetNoBN(AbstractESModel):
         self.in_dim = torch.Size((1, 28, 28))
         self.conv1 = nn.Conv2d(1, 10, kernel_size=(5, 5))
         self.conv1_pool = nn.MaxPool2d(kernel_size=(2, 2), stride=None, padding=0, dilation=1, return_indices=False, ceil_mode=False)
-        self.conv1_relu = nn.ReLU()
+        self.conv1_relu = nn.ReLU(inplace=True)
 
         self.conv2 = nn.Conv2d(10, 20, kernel_size=(5, 5))
         self.conv2_pool = nn.MaxPool2d(kernel_size=(2, 2), stride=None, padding=0, dilation=1, return_indices=False, ceil_mode=False)
-        self.conv2_relu = nn.ReLU()
+        self.conv2_relu = nn.ReLU(inplace=True)
 
         self.fc1 = nn.Linear(320, 50)
-        self.fc1_relu = nn.ReLU()
+        self.fc1_relu = nn.ReLU(inplace=True)
 
         self.fc2 = nn.Linear(50, 10)
         self.fc2_logsoftmax = nn.LogSoftmax(dim=1)
@@ -493,7 +539,7 @@ class MNISTNetNoBN(AbstractESModel):
     def forward(self, x):
         x = self.conv1_relu(self.conv1_pool(self.conv1(x)))
         x = self.conv2_relu(self.conv2_pool(self.conv2(x)))
-        x = x.view(-1, 320)
+        x = x.reshape(-1, 320)
         x = self.fc1_relu(self.fc1(x))
         x = self.fc2_logsoftmax(self.fc2(x))
         return x
@@ -507,14 +553,14 @@ class MNISTNetNoInit(MNISTNet):
         self.in_dim = torch.Size((1, 28, 28))
         self.conv1 = nn.Conv2d(1, 10, kernel_size=(5, 5))
         self.conv1_pool = nn.MaxPool2d(kernel_size=(2, 2), stride=None, padding=0, dilation=1, return_indices=False, ceil_mode=False)
-        self.conv1_relu = nn.ReLU()
+        self.conv1_relu = nn.ReLU(inplace=True)
 
         self.conv2 = nn.Conv2d(10, 20, kernel_size=(5, 5))
         self.conv2_pool = nn.MaxPool2d(kernel_size=(2, 2), stride=None, padding=0, dilation=1, return_indices=False, ceil_mode=False)
-        self.conv2_relu = nn.ReLU()
+        self.conv2_relu = nn.ReLU(inplace=True)
 
         self.fc1 = nn.Linear(320, 50)
-        self.fc1_relu = nn.ReLU()
+        self.fc1_relu = nn.ReLU(inplace=True)
 
         self.fc2 = nn.Linear(50, 10)
         self.fc2_logsoftmax = nn.LogSoftmax(dim=1)
@@ -562,7 +608,7 @@ class CIFARNet(nn.Module):
     def __init__(self, n=10):
         super(CIFARNet, self).__init__()
 
-        IPython.embed()
+        raise NotImplementedError('CIFARNet is not yet implemented')
         self.in_dim = torch.Size((1, 28, 28))
         self.conv1 = nn.Conv2d(3, 96, (11, 11), stride=4)
         self.conv1_bn = nn.BatchNorm2d(96)
@@ -584,13 +630,20 @@ class CIFARNet(nn.Module):
     def forward(self, x):
         x = self.pool(F.relu(self.conv1(x)))
         x = self.pool(F.relu(self.conv2(x)))
-        x = x.view(-1, 16 * 5 * 5)
+        x = x.reshape(-1, 16 * 5 * 5)
         x = F.relu(self.fc1(x))
         x = F.relu(self.fc2(x))
         x = self.fc3(x)
         return x
 
 
+def squash(tensor, dim=-1):
+    """Squashes the vectors along `dim` to have lengths in [0, 1) while keeping their directions.
+    """
+    norm = tensor.norm(dim=dim, keepdim=True)
+    return norm / (1 + norm * norm) * tensor
+
+
 class CapsuleLayer(nn.Module):
     def __init__(self, num_capsules, num_route_nodes, in_channels, out_channels, kernel_size=None, stride=None,
                  num_iterations=3):
@@ -605,31 +658,28 @@ class CapsuleLayer(nn.Module):
                 [nn.Conv2d(in_channels, out_channels, kernel_size=kernel_size, stride=stride, padding=0) for _ in
                  range(num_capsules)])
 
-    def squash(self, tensor, dim=-1):
-        squared_norm = (tensor ** 2).sum(dim=dim, keepdim=True)
-        scale = squared_norm / (1 + squared_norm)
-        return scale * tensor / torch.sqrt(squared_norm)
-
+    @torch.compile(dynamic=False, fullgraph=True)
     def forward(self, x):
         if self.num_route_nodes != -1:
             priors = x[None, :, :, None, :] @ self.route_weights[:, None, :, :, :]
-            logits = Variable(torch.zeros(*priors.size())).cuda()
+            logits = torch.zeros_like(priors)
             for i in range(self.num_iterations):
-                probs = capsule_softmax(logits, dim=2)
-                outputs = self.squash((probs * priors).sum(dim=2, keepdim=True))
+                probs = F.softmax(logits, dim=2)
+                outputs = squash((probs * priors).sum(dim=2, keepdim=True))
                 if i != self.num_iterations - 1:
                     delta_logits = (priors * outputs).sum(dim=-1, keepdim=True)
                     logits = logits + delta_logits
         else:
             outputs = [capsule(x).view(x.size(0), -1, 1) for capsule in self.capsules]
             outputs = torch.cat(outputs, dim=-1)
-            outputs = self.squash(outputs)
+            outputs = squash(outputs)
         return outputs
 
 
 class CapsuleNet(nn.Module):
     def __init__(self, n_classes):
         super(CapsuleNet, self).__init__()
+        self.n_classes = n_classes
         self.conv1 = nn.Conv2d(in_channels=1, out_channels=256, kernel_size=9, stride=1)
         self.primary_capsules = CapsuleLayer(num_capsules=8, num_route_nodes=-1, in_channels=256, out_channels=32,
                                              kernel_size=9, stride=2)
@@ -653,20 +703,26 @@ class CapsuleNet(nn.Module):
         if y is None:
             # In all batches, get the most active capsule.
             _, max_length_indices = classes.max(dim=1)
-            y = Variable(torch.sparse.torch.eye(n_classes)).cuda().index_select(dim=0, index=max_length_indices.data)
+            y = F.one_hot(max_length_indices, num_classes=self.n_classes).to(x.dtype)
         reconstructions = self.decoder((x * y[:, :, None]).view(x.size(0), -1))
         return classes, reconstructions
 
 
+@torch.compile(fullgraph=True)
+def capsule_margin_loss(labels, classes, margin_up=0.9, margin_down=0.1):
+    """Computes the summed margin loss of the capsule lengths in `classes` fused into a single kernel.
+    """
+    left = F.relu(margin_up - classes) ** 2
+    right = F.relu(classes - margin_down) ** 2
+    return (labels * left + 0.5 * (1. - labels) * right).sum()
+
+
 class CapsuleLoss(nn.Module):
     def __init__(self):
         super(CapsuleLoss, self).__init__()
-        self.reconstruction_loss = nn.MSELoss(size_average=False)
+        self.reconstruction_loss = nn.MSELoss(reduction='sum')
 
     def forward(self, images, labels, classes, reconstructions):
-        left = F.relu(0.9 - classes, inplace=True) ** 2
-        right = F.relu(classes - 0.1, inplace=True) ** 2
-        margin_loss = labels * left + 0.5 * (1. - labels) * right
-        margin_loss = margin_loss.sum()
+        margin_loss = capsule_margin_loss(labels, classes)
         reconstruction_loss = self.reconstruction_loss(reconstructions, images)
         return (margin_loss + 0.0005 * reconstruction_loss) / images.size(0)
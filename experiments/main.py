@@ -5,22 +5,21 @@ import pickle
 import platform
 
 import gym
-import IPython
 import numpy as np
 import torch
 import torch.multiprocessing as mp
 import torch.nn as nn
 import torch.nn.functional as F
 import torch.optim as optim
-from torch.autograd import Variable
 
 from context import es, utils
 from es.algorithms import GA, ES, NES, sES, sNES, xNES
 from es.envs import create_gym_environment
-from es.eval_funs import gym_render, gym_rollout, gym_test, supervised_eval, supervised_test
+from es.eval_funs import gym_render, gym_rollout, gym_test, supervised_eval, supervised_eval_batched, supervised_test
 from es.models import *
-from torchvision import datasets, transforms
+from torchvision import datasets
 from utils.misc import get_inputs_from_dict, get_inputs_from_dict_class
+from utils.torchutils import NormalizeImages, TensorDataLoader, preload_image_dataset
 
 
 def parse_inputs():
@@ -100,6 +99,9 @@ def parse_inputs():
     parser.add_argument('--use-new-algorithm', action='store_true', help='Whether to use a new algorithm setting on the restored checkpoint')
     parser.add_argument('--cuda', action='store_true', default=False, help='Enables CUDA training')
     parser.add_argument('--silent', action='store_true', help='Silence print statements during training')
+    parser.add_argument('--debug', action='store_true', help='Check that perturbations, gradients and sensitivities are finite')
+    parser.add_argument('--compile-mode', type=str, default=None, metavar='CM', help='Compile the forward pass of the model with torch.compile in this mode (e.g. reduce-overhead or max-autotune). Defaults to no compilation')
+    parser.add_argument('--batch-eval', action='store_true', help='Evaluate all perturbations in a single vectorized forward pass (supervised models without batch normalization)')
     parser.add_argument('--do-permute-train-labels', action='store_true', help='Permute the training labels randomly')
     parser.add_argument('--lr-from-perturbations', type=int, default=0, help='Get the learning rate heuristically from the number of perturbations')
     args = parser.parse_args()
@@ -127,6 +129,7 @@ def validate_inputs(args):
     else:
         args.is_supervised = True
         args.is_rl = False
+    assert not args.batch_eval or args.is_supervised                    # Batch evaluation is only implemented for supervised problems
 
 
 def create_model(args):
@@ -147,6 +150,14 @@ def create_model(args):
     # CUDA
     if args.cuda:
         args.model = args.model.cuda()
+        # Input sizes are fixed so cuDNN can benchmark and cache the fastest convolution algorithms once
+        torch.backends.cudnn.benchmark = True
+        if args.is_supervised:
+            # Channels last (NHWC) layout avoids the transposes cuDNN otherwise does for its convolution kernels
+            args.model = args.model.to(memory_format=torch.channels_last)
+    # Compile
+    if args.compile_mode is not None:
+        args.model.compile_forward(args.compile_mode)
 
 
 def create_optimizer(args):
@@ -176,7 +187,7 @@ def create_environment(args):
     if args.is_rl:
         args.env = create_gym_environment(args.env_name, sqaure_size=args.frame_size)
     elif args.is_supervised:
-        # Create normalization transforms (values computed by torchutils.dataset_mean_and_var)
+        # Normalization constants (values computed by torchutils.dataset_mean_and_var)
         if args.env_name == 'MNIST':
             data_set = datasets.MNIST
             mean = (0.130660742521286,)
@@ -193,25 +204,23 @@ def create_environment(args):
             data_set = datasets.CIFAR100
             mean = (0.5141649842262268, 0.47902533411979675, 0.4298681914806366)
             var = (0.2685449421405792, 0.26044416427612305, 0.28062567114830017)
-        # Arguments for data set
+        # Load the data sets into memory and normalize each batch on the device it is evaluated on
         data_dir = os.path.join(args.file_path, 'data', args.env_name)
-        transform = transforms.Compose([transforms.ToTensor(), transforms.Normalize(mean, var)])
-        train_set_kwargs = {'train': True, 'download': True, 'transform': transform}
-        test_set_kwargs = {'train': False, 'download': True, 'transform': transform}
-        # Create dataset and DataLoader
-        train_set = data_set(data_dir, **train_set_kwargs)
-        test_set = data_set(data_dir, **test_set_kwargs)
-        # Arguments for data loader
-        batch_size = args.batch_size if not(args.test) else 1000
-        train_loader_kwargs = {'num_workers': 0, 'batch_size': batch_size, 'shuffle': True}
-        test_loader_kwargs = {'num_workers': 0, 'batch_size': len(test_set), 'shuffle': True}
-        if args.cuda:
-            train_loader_kwargs['pin_memory'] = True
+        train_set = preload_image_dataset(data_set(data_dir, train=True, download=True))
+        test_set = preload_image_dataset(data_set(data_dir, train=False, download=True))
         if not args.test and args.do_permute_train_labels:
             # Permute the labels randomly to test 'Rethinking Generalization'
-            train_set.train_labels = torch.LongTensor(np.random.permutation(train_set.train_labels))
-        args.env = torch.utils.data.DataLoader(train_set, **train_loader_kwargs)
-        args.val_env = torch.utils.data.DataLoader(test_set, **test_loader_kwargs)
+            data, targets = train_set.tensors
+            train_set = torch.utils.data.TensorDataset(data, targets[torch.randperm(len(targets))].share_memory_())
+        # Arguments for data loader
+        batch_size = args.batch_size if not(args.test) else 1000
+        # The training and validation loaders are sent to the CPU evaluation workers so they stay on the CPU
+        loader_kwargs = {'shuffle': True, 'collate_fn': NormalizeImages(mean, var), 'name': args.env_name}
+        args.env = TensorDataLoader(train_set, batch_size=batch_size, **loader_kwargs)
+        args.val_env = TensorDataLoader(test_set, batch_size=len(test_set), **loader_kwargs)
+        # Testing is done in the main process and loads the batches directly onto the GPU
+        args.test_env = TensorDataLoader(test_set, batch_size=len(test_set), shuffle=True, pin_memory=args.cuda, device='cuda' if args.cuda else None,
+                                         collate_fn=NormalizeImages(mean, var, channels_last=args.cuda), name=args.env_name)
     
     assert hasattr(args, 'env')
 
@@ -245,6 +254,7 @@ def get_eval_funs(args):
     elif args.is_supervised:
         args.eval_fun = supervised_eval
         args.test_fun = supervised_test
+        args.batch_eval_fun = supervised_eval_batched if args.batch_eval else None
 
 
 def get_lr_from_perturbations(args):
@@ -263,11 +273,13 @@ def test_model(args):
     args.algorithm.model.eval()
     if args.cuda:
         args.algorithm.model.cuda()
+    if hasattr(args.algorithm.model, 'fuse_for_eval'):
+        args.algorithm.model.fuse_for_eval()
     if args.is_rl:
         # args.test_fun(args.algorithm.model, args.env, max_episode_length=args.batch_size, n_episodes=100, chkpt_dir=args.chkpt_dir)
         args.rend_fun(args.algorithm.model, args.env, max_episode_length=args.batch_size)
     else:
-        args.test_fun(args.algorithm.model, args.val_env, cuda=args.cuda, chkpt_dir=args.chkpt_dir)
+        args.test_fun(args.algorithm.model, args.test_env, chkpt_dir=args.chkpt_dir)
         #args.rend_fun(args.algorithm.mode, args.env, max_episode_length=args.batch_size)
 
 
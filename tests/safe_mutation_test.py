@@ -0,0 +1,63 @@
+import copy
+
+import torch
+import torch.optim as optim
+
+from context import es
+from es.algorithms import ES
+from es.eval_funs import supervised_eval
+from es.models import MNISTNet, MNISTNetNoBN
+
+
+def create_algorithm(model, env, safe_mutation='SUM'):
+    optimizer = optim.SGD(model.parameters(), lr=0.1)
+    lr_scheduler = optim.lr_scheduler.ExponentialLR(optimizer, 1.0)
+    return ES(model, env, optimizer, lr_scheduler, supervised_eval, perturbations=4, batch_size=8, max_generations=1,
+              safe_mutation=safe_mutation, no_antithetic=False, sigma=0.05, workers=1, silent=True)
+
+
+def sensitivities_sum_backward(model, inputs):
+    """
+    SM-G-SUM sensitivities computed with a backward pass for each output unit.
+    """
+    outputs = model(inputs)
+    sensitivities = [torch.zeros_like(p) for p in model.parameters()]
+    for k in range(outputs.size(1)):
+        model.zero_grad()
+        t = torch.zeros_like(outputs)
+        t[:, k] = 1
+        outputs.backward(t, retain_graph=True)
+        for sens, p in zip(sensitivities, model.parameters()):
+            sens += p.grad.pow(2)
+    return [sens.sqrt() for sens in sensitivities]
+
+
+def test_sensitivities_sum(ModelClass):
+    """
+    Test that the Jacobian based SM-G-SUM sensitivities equal those of the backward pass per output unit
+    and that batch normalization running statistics are updated as by a single forward pass.
+    """
+    torch.manual_seed(1)
+    inputs = torch.randn(8, 1, 28, 28)
+    env = torch.utils.data.DataLoader(torch.utils.data.TensorDataset(inputs, torch.zeros(8).long()), batch_size=8)
+    model = ModelClass()
+    control_model = copy.deepcopy(model)
+    algorithm = create_algorithm(model, env)
+    algorithm.model.load_state_dict(control_model.state_dict())
+
+    method_sens = algorithm._compute_sensitivities_sum(inputs)
+    control_sens = sensitivities_sum_backward(control_model, inputs)
+
+    print("TEST " + ModelClass.__name__)
+    for idx, (m, c) in enumerate(zip(method_sens, control_sens)):
+        assert torch.allclose(m, c, rtol=1e-4, atol=1e-5), "Sensitivities of parameter {:d} do not match".format(idx)
+    print("✓ Model and control sensitivities match!")
+    for (name, m), c in zip(algorithm.model.named_buffers(), control_model.buffers()):
+        assert torch.allclose(m.float(), c.float()), "Buffer {:s} does not match".format(name)
+    print("✓ Model and control buffers match!")
+    print("============================================================")
+
+
+if __name__ == '__main__':
+    test_sensitivities_sum(MNISTNetNoBN)
+    test_sensitivities_sum(MNISTNet)
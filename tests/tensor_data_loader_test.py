@@ -0,0 +1,43 @@
+import torch
+
+from context import es
+from es.eval_funs import supervised_eval
+from es.models import MNISTNet
+from safe_mutation_test import create_algorithm
+from utils.torchutils import NormalizeImages, TensorDataLoader
+
+
+def create_loader(batch_size=8):
+    data = torch.randint(0, 256, (32, 1, 28, 28), dtype=torch.uint8)
+    targets = torch.randint(0, 10, (32,))
+    dataset = torch.utils.data.TensorDataset(data, targets)
+    return TensorDataLoader(dataset, batch_size=batch_size, shuffle=True, collate_fn=NormalizeImages((0.1307,), (0.3081,)), name='MNIST')
+
+
+def test_algorithm_on_tensor_data_loader(safe_mutation):
+    """
+    Test that an algorithm can be created and evaluated on a `TensorDataLoader`.
+    """
+    torch.manual_seed(1)
+    env = create_loader()
+    algorithm = create_algorithm(MNISTNet(), env, safe_mutation=safe_mutation)
+
+    print("TEST safe_mutation = " + str(safe_mutation))
+    expected_size = 2 if safe_mutation is None else 8
+    assert algorithm.sens_inputs.size() == torch.Size((expected_size, 1, 28, 28)), "Sensitivity inputs were not taken from the loader"
+    print("✓ Sensitivity inputs were taken from the loader!")
+    algorithm.compute_sensitivities()
+    if safe_mutation is not None:
+        for sens, p in zip(algorithm.sensitivities, algorithm.model.parameters()):
+            assert sens.size() == p.size()
+    print("✓ Sensitivities were computed!")
+    out = supervised_eval(algorithm.model, env, 42)
+    assert out['observations'] == 8
+    print("✓ Model was evaluated on the loader!")
+    print("============================================================")
+
+
+if __name__ == '__main__':
+    test_algorithm_on_tensor_data_loader(None)
+    test_algorithm_on_tensor_data_loader('SUM')
+    test_algorithm_on_tensor_data_loader('ABS')
@@ -3,10 +3,44 @@
 
 import os
 import argparse
-import IPython
 import torch
 import filesystem as fs
 
+def clean_directory(root, keep, delete):
+    """Removes the files in `root` and its sub directories that are to be deleted or not kept.
+
+    Directories left with only an init.log are removed entirely. Files in analysis directories are kept.
+    """
+    i = 0
+    filenames = []
+    directories = []
+    with os.scandir(root) as entries:
+        for entry in entries:
+            if entry.is_dir():
+                if not entry.is_symlink():
+                    directories.append(entry.path)
+                continue
+            filenames.append(entry.name)
+            if 'analysis' in root:
+                continue
+            if entry.name in delete or entry.name not in keep:
+                os.unlink(entry.path)
+                i += 1
+            # elif entry.name == 'state-dict-algorithm.pkl':
+            #     s = torch.load(entry.path)
+            #     if 'sensitivities' in s:
+            #         del s['sensitivities']
+            #         torch.save(s, entry.path)
+    if filenames == ['init.log']:
+        os.unlink(os.path.join(root, 'init.log'))
+        os.rmdir(root)
+        i += 1
+    if i > 0:
+        print('Removed {:d} {:s} in {:s}'.format(i, 'file' if i == 1 else 'files', root))
+    for directory in directories:
+        clean_directory(directory, keep, delete)
+
+
 if __name__ == '__main__':
     # Ask to continue
     r = input('This script should not be run while algorithms are executing as this risks deleting their checkpoints.\nProceed? (y/n) ')
@@ -31,25 +65,4 @@ if __name__ == '__main__':
     assert args.d is not None and args.delete is not None
 
     # Run
-    for root, directories, filenames in os.walk(args.d):
-        i = 0
-        for filename in filenames:
-            if 'analysis' in root:
-                continue
-            if filename in args.delete:
-                os.remove(os.path.join(root, filename))
-                i += 1
-            elif filename not in args.keep:
-                os.remove(os.path.join(root, filename))
-                i += 1
-            # elif filename == 'state-dict-algorithm.pkl':
-            #     s = torch.load(os.path.join(root, filename))
-            #     if 'sensitivities' in s:
-            #         del s['sensitivities']
-            #         torch.save(s, os.path.join(root, filename))
-        if len(filenames) == 1 and filenames[0] == 'init.log':
-            os.remove(os.path.join(root, filenames[0]))
-            os.rmdir(os.path.join(root))
-            i += 1
-        if i > 0:
-            print('Removed {:d} {:s} in {:s}'.format(i, 'file' if i == 1 else 'files', root))
+    clean_directory(args.d, frozenset(args.keep), frozenset(args.delete))
@@ -33,38 +33,36 @@ def build_vector(stats, keys):
 
 
 def print_group_info(algorithm_states, groups, directory):
-    omit_keys = ['sensitivities', 'sens_inputs', 'chkpt_dir', 'chkpt_int', 'cuda', 'exclude_from_state_dict']
-    omit_keys.extend([k for k in algorithm_states[0].keys() if k[0] == '_'])
+    omit_keys = {'sensitivities', 'sens_inputs', 'chkpt_dir', 'chkpt_int', 'cuda', 'exclude_from_state_dict'}
+    omit_keys.update(k for k in algorithm_states[0].keys() if k[0] == '_')
+    omit_keys = frozenset(omit_keys)
     _, indices = np.unique(groups, return_index=True)
-    unique_states = [algorithm_states[i] for i in indices]
-    longest_key_len = 0
-    longest_val_len = 0
-    for s in unique_states:
-        for k, v in s.items():
-            if not k in omit_keys:
-                longest_key_len = max(longest_key_len, len(k))
-                longest_val_len = max(longest_val_len, len(str(v)))
+    # Convert values to strings once
+    rendered_states = [{k: str(v) for k, v in algorithm_states[i].items() if k not in omit_keys} for i in indices]
+    longest_key_len = max((len(k) for s in rendered_states for k in s), default=0)
+    longest_val_len = max((len(v) for s in rendered_states for v in s.values()), default=0)
     format_str = '{0:' + str(longest_key_len) + 's}\t{1:' + str(longest_val_len) + 's}\n'
+    separator = '='*(len(format_str.format('0', '0'))-1) + '\n'
     with open(os.path.join(directory, 'groups.info'), 'w') as f:
-        for g_id, s in enumerate(unique_states):
-            f.write('='*(len(format_str.format('0', '0'))-1) + '\n')
+        for g_id, s in enumerate(rendered_states):
+            f.write(separator)
             f.write(format_str.format('GROUP', str(g_id)))
             for k, v in s.items():
-                if not k in omit_keys:
-                    f.write(format_str.format(k, str(v)))
+                f.write(format_str.format(k, v))
 
 
 def get_best(algorithm_states, key='return_unp', operation='max'):
     """Return the best run among several as measured by `key` and
-    the `operation`
+    the `operation` which is either `max` or `min`
     """
-    best_id = 0
-    best_return = 0
-    for i, s in enumerate(algorithm_states):
-        if max(s['stats'][key]) > best_return:
-            best_return = max(s['stats'][key])
-            best_id = i
-    return algorithm_states[best_id]
+    if operation == 'max':
+        reduce_fun, arg_fun = np.max, np.argmax
+    elif operation == 'min':
+        reduce_fun, arg_fun = np.min, np.argmin
+    else:
+        raise ValueError("Operation must be either 'max' or 'min' but was '{}'".format(operation))
+    bests = np.array([reduce_fun(s['stats'][key]) for s in algorithm_states])
+    return algorithm_states[int(arg_fun(bests))]
 
 
 def get_max_chkpt_int(algorithm_states):
@@ -86,16 +84,19 @@ def invert_signs(stats_list, keys='all'):
         stats_list (list): [description]
         keys (dict): [description]
     """
-    if keys == 'all':
-        keys = {'return_unp', 'return_max', 'return_min', 'return_avg', 'return_val'}
+    return_keys = {'return_unp', 'return_max', 'return_min', 'return_avg', 'return_val'}
+    if keys != 'all':
+        return_keys = return_keys.intersection(keys)
     for s in stats_list:
-        if (np.array(s['return_unp']) < 0).all():
-            for k in {'return_unp', 'return_max', 'return_min', 'return_avg', 'return_val'}.intersection(keys).intersection(set(s.keys())):
-                s[k] = [-retrn for retrn in s[k]]
+        if (np.asarray(s['return_unp']) < 0).all():
+            for k in return_keys.intersection(s.keys()):
+                inverted = -np.asarray(s[k], dtype=float)
+                s[k] = inverted.tolist() if isinstance(s[k], list) else inverted
 
 
 def get_checkpoint_directories(dir):
-    return [os.path.join(dir, di) for di in os.listdir(dir) if os.path.isdir(os.path.join(dir, di)) and di != 'monitoring']
+    with os.scandir(dir) as it:
+        return [entry.path for entry in it if entry.is_dir() and entry.name != 'monitoring']
 
 
 def lookup_label(key, mode='supervised'):
@@ -6,7 +6,6 @@ import time
 from functools import partial
 
 import dropbox
-import IPython
 import numpy as np
 from dropbox.exceptions import ApiError, DropboxException, InternalServerError
 from dropbox.files import WriteMode
@@ -1,7 +1,6 @@
 import inspect
 import os
 
-import IPython
 import numpy as np
 
 
@@ -3,7 +3,6 @@ import itertools
 import collections
 import sys
 
-import IPython
 import numpy as np
 
 
@@ -1,14 +1,12 @@
 import os
 from ast import literal_eval
 
-import IPython
 import matplotlib as mpl
 mpl.use('Agg')
 import matplotlib.pyplot as plt
 import numpy as np
 import pandas as pd
 import scipy.stats as st
-import seaborn as sns
 import torch
 from cycler import cycler
 
@@ -21,22 +19,41 @@ def moving_average(y, window=100, center=True):
     Compute a moving average with of `window` observations in `y`. If `centered=True`, the 
     average is computed on `window/2` observations before and after the value of `y` in question. 
     If `centered=False`, the average is computed on the `window` previous observations.
+    If `y` is two dimensional, the moving average of each column is computed.
     """
-    if type(y) != list:
-        y = list(y)
-    return pd.Series(y).rolling(window=window, center=center).mean()
+    y = np.asarray(y, dtype=np.float64)
+    ma = np.full(y.shape, np.nan)
+    if window > y.shape[0]:
+        return ma
+    # Windowed sums from cumulative sums. Windows containing NaNs are NaN as with pandas rolling.
+    isnan = np.isnan(y)
+    zeros = np.zeros((1, *y.shape[1:]))
+    c = np.concatenate((zeros, np.cumsum(np.where(isnan, 0, y), axis=0)))
+    n = np.concatenate((zeros, np.cumsum(isnan, axis=0)))
+    means = (c[window:] - c[:-window]) / window
+    means[n[window:] - n[:-window] > 0] = np.nan
+    start = window - 1 - (window - 1) // 2 if center else window - 1
+    ma[start:start + means.shape[0]] = means
+    return ma
+
+
+def nan_padded_array(ydatas):
+    """
+    Stack the sequences in `ydatas` as the rows of an array padded with NaN to the length of the longest sequence.
+    """
+    ydata = np.full((len(ydatas), max(map(len, ydatas))), np.nan)
+    for i, y in enumerate(ydatas):
+        ydata[i, :len(y)] = y
+    return ydata
 
 
 def remove_duplicate_labels(ax):
     handles, labels = ax.get_legend_handles_labels()
-    i =1
-    while i<len(labels):
-        if labels[i] in labels[:i]:
-            del(labels[i])
-            del(handles[i])
-        else:
-            i +=1
-    ax.legend(handles, labels)
+    # Keep the first handle of each label in the order the labels are first seen
+    unique = {}
+    for handle, label in zip(handles, labels):
+        unique.setdefault(label, handle)
+    ax.legend(list(unique.values()), list(unique.keys()))
 
 
 def timeseries(xdatas, ydatas, xlabel, ylabel, plotlabels=None, figsize=(6.4, 4.8), map_labels=False):
@@ -50,7 +67,7 @@ def timeseries(xdatas, ydatas, xlabel, ylabel, plotlabels=None, figsize=(6.4, 4.
     maxs = []
     for xdata, ydata, plotlabel in zip(xdatas, ydatas, plotlabels):
         ydata = moving_average(ydata)
-        maxs.append(np.max(ydata))
+        maxs.append(np.nanmax(ydata))
         handles.extend(plt.plot(xdata, ydata, label=plotlabel))
     if plotlabels is not None:
         plt.legend(handles=handles, ncol=2, loc='best')
@@ -65,10 +82,10 @@ def timeseries_distribution(xdatas, ydatas, xlabel, ylabel, xbins=100, ybins=100
         ylabel = lookup_label(ylabel, mode=map_labels)
     plt.rcParams['image.cmap'] = 'viridis'
     # Get x and y edges spanning all values
-    maxx = max([max(xdata) for xdata in xdatas])
-    minx = min([min(xdata) for xdata in xdatas])
-    maxy = max([max(ydata) for ydata in ydatas])
-    miny = min([min(ydata) for ydata in ydatas])
+    xall = np.concatenate([np.asarray(xdata, dtype=np.float64) for xdata in xdatas])
+    yall = np.concatenate([np.asarray(ydata, dtype=np.float64) for ydata in ydatas])
+    maxx, minx = xall.max(), xall.min()
+    maxy, miny = yall.max(), yall.min()
     xedges = np.linspace(minx, maxx, num=xbins)
     yedges = np.linspace(miny, maxy, num=ybins)
     # Use number of bins instead if only single unique value in data
@@ -76,16 +93,10 @@ def timeseries_distribution(xdatas, ydatas, xlabel, ylabel, xbins=100, ybins=100
             yedges = ybins
     if maxx == minx:
         xedges = xbins
-    H, xedges, yedges = np.histogram2d(xdatas[0], ydatas[0], bins=(xedges, yedges))
-    counts = np.zeros(H.shape)
-    counts += H
-    for xdata, ydata in zip(xdatas[1:], ydatas[1:]):
-        H, xedges, yedges = np.histogram2d(xdata, ydata, bins=(xedges, yedges))
-        counts += H
+    counts, xedges, yedges = np.histogram2d(xall, yall, bins=(xedges, yedges))
     counts = counts/counts.max()
-    X, Y = np.meshgrid(xedges, yedges)
     fig, ax = plt.subplots(figsize=figsize)
-    plt.pcolormesh(X, Y, counts.T, linewidth=0, rasterized=True)
+    plt.pcolormesh(xedges, yedges, counts.T, linewidth=0, rasterized=True)
     plt.colorbar()
     plt.xlabel(xlabel)
     plt.ylabel(ylabel)
@@ -95,11 +106,7 @@ def timeseries_median(xdatas, ydatas, xlabel, ylabel, figsize=(6.4, 4.8), map_la
     if map_labels:
         xlabel = lookup_label(xlabel, mode=map_labels)
         ylabel = lookup_label(ylabel, mode=map_labels)
-    length = len(sorted(ydatas, key=len, reverse=True)[0])
-    ydata = []
-    for i in range(len(ydatas)):
-        ydata.append(ydatas[i] + [np.NaN] * (length-len(ydatas[i])))
-        ydata[i] = np.array(ydata[i])
+    ydata = nan_padded_array(ydatas)
     yavgs = np.nanmedian(ydata, 0)
     ymaxs = np.nanmax(ydata, 0)
     ymins = np.nanmin(ydata, 0)
@@ -129,33 +136,37 @@ def timeseries_mean_grouped(xdatas, ydatas, groups, xlabel, ylabel, figsize=(6.4
     if map_labels:
         xlabel = lookup_label(xlabel, mode=map_labels)
         ylabel = lookup_label(ylabel, mode=map_labels)
+    # Seaborn is slow to import and only used here
+    import seaborn as sns
     sns.set(color_codes=True)
     plt.figure(figsize=figsize)
     legend = []
-    n_groups = len(np.unique(groups))
+    # Indices of the members of each group, in their original order, from a single sort
+    group_values, group_inverse = np.unique(groups, return_inverse=True)
+    order = np.argsort(group_inverse, kind='stable')
+    group_indices = np.split(order, np.cumsum(np.bincount(group_inverse))[:-1])
+    n_groups = len(group_values)
     # if n_groups <= 6:
     #     colors = plt.cm.gnuplot(np.linspace(0, 1, n_groups))
     #     #colors = np.reshape(np.append(colors[0::2], colors[1::2]), (6, 4))
     # else:
     colors = plt.cm.gnuplot(np.linspace(0, 1, n_groups))
     sns.set_style("ticks")
-    for g, c in zip(np.unique(groups), colors[0:n_groups]):
+    for g, g_indices, c in zip(group_values, group_indices, colors[0:n_groups]):
         if type(g) in [str, np.str, np.str_]:
             gstr = g
         else:
             gstr = 'G{0:02d}'.format(g)
         legend.append(gstr)
-        g_indices = np.where(groups == g)[0]
         ydatas_grouped = [ydatas[i] for i in g_indices]
-        length = len(sorted(ydatas_grouped, key=len, reverse=True)[0])
+        ydata = nan_padded_array(ydatas_grouped)
+        length = ydata.shape[1]
         nsub = int(length/points_in_plot) if points_in_plot < length else 1
-        ydata = np.array([ydata+[np.NaN]*(length-len(ydata)) for ydata in ydatas_grouped])
         # Subsample y
         ydata_subsampled = ydata[:,::nsub] if np.prod(ydata.shape) > nsub else ydata
         # if ydata_subsampled[-1] != ydata[-1]:
         #     ydata_subsampled = np.append(ydata_subsampled, ydata[0,-1])
-        x = [xdatas[i] for i in g_indices]
-        x = get_longest_sublists(x)[0]
+        x = max([xdatas[i] for i in g_indices], key=len)
         if type(x) in [range, list]:
             x = np.array(x)
         # Subsample x
@@ -169,16 +180,20 @@ def timeseries_mean_grouped(xdatas, ydatas, groups, xlabel, ylabel, figsize=(6.4
 
 
 def load_stats(stats_file):
-    stats = pd.read_csv(stats_file)
+    stats = pd.read_csv(stats_file, engine='c')
     for k in stats.keys()[stats.dtypes == object]:
+        # Only columns of list or tuple literals are parsed, detected from the first entry
+        values = stats[k].dropna().values
+        if len(values) == 0 or not isinstance(values[0], str) or values[0][:1] not in ('[', '('):
+            continue
         try:
-            stats[k] = stats[k].apply(literal_eval)
-        except:
+            stats[k] = [literal_eval(v) if isinstance(v, str) else v for v in stats[k].values]
+        except (ValueError, SyntaxError):
             pass
     return stats
 
 
-def plot_stats(stats_file, chkpt_dir, wide_figure=True, map_labels=False):
+def plot_stats(stats_file, chkpt_dir, wide_figure=True, map_labels=False, force=False):
     """
     Plots training statistics
     - Unperturbed return
@@ -198,6 +213,8 @@ def plot_stats(stats_file, chkpt_dir, wide_figure=True, map_labels=False):
     - Episodes
     - Observations
     - Walltimes
+
+    Plots whose PDF is newer than `stats_file` are up to date and are not redrawn unless `force=True`.
     """
 
     # Plot settings
@@ -212,6 +229,7 @@ def plot_stats(stats_file, chkpt_dir, wide_figure=True, map_labels=False):
     # Load data
     try:
         stats = load_stats(stats_file)
+        stats_mtime = os.path.getmtime(stats_file)
     except:
         return
 
@@ -229,44 +247,50 @@ def plot_stats(stats_file, chkpt_dir, wide_figure=True, map_labels=False):
     stats['parallel_fraction'] = stats['workertimes']/stats['time_per_generation']
 
     # Compute moving averages
-    for c in stats.columns:
-        if not 'Unnamed' in c and c[-3:] != '_ma':
-            stats[c + '_ma'] = stats[c].rolling(window=100, center=True, win_type=None).mean()
+    columns = [c for c in stats.columns if not 'Unnamed' in c and c[-3:] != '_ma']
+    moving_averages = moving_average(stats[columns].values, window=100, center=True)
+    moving_averages = pd.DataFrame(moving_averages, index=stats.index, columns=[c + '_ma' for c in columns])
+    stats = pd.concat([stats, moving_averages], axis=1)
         
-    # Plot each of the columns including moving average
-    c_list = stats.columns.tolist()
-    while c_list:
-        c = c_list.pop()
-        is_unnamed = lambda c: 'Unnamed' in c
-        is_part_of_multi_series = lambda c: c.split('_')[-1].isdigit()
-        is_moving_average = lambda c: c[-3:] == '_ma'
-        if not is_unnamed(c) and not is_moving_average(c):
-            if is_part_of_multi_series(c):
-                # Find all c that are in this series
-                cis = {ci for ci in stats.columns if ci.split('_')[:-1] == c.split('_')[:-1] and not is_moving_average(c)}
-                for ci in cis.difference({c}):
-                    c_list.remove(ci)
-                cis = sorted(list(cis))
-                c = ''.join(c.split('_')[:-1])
-                # Loop over them and plot into same plot
-                fig, ax = plt.subplots(figsize=figsize)
-                for ci in cis:
-                    stats[ci].plot(ax=ax, linestyle='None', marker='.', alpha=0.2, label='_nolegend_')
-                ax.set_prop_cycle(None)
-                for ci in cis:
-                    stats[ci + '_ma'].plot(ax=ax, linestyle='-', label=ci)
-                box = ax.get_position()
-                ax.set_position([box.x0, box.y0, box.width * 0.8, box.height])
-                ax.legend(loc='center left', bbox_to_anchor=(1, 0.5))
-            else:
-                fig, ax = plt.subplots(figsize=figsize)
-                stats[c].plot(ax=ax, alpha=0.2, linestyle='None', marker='.', label='_nolegend_')
-                ax.set_prop_cycle(None)
-                stats[c + '_ma'].plot(ax=ax, linestyle='-', label='_nolegend_')
-                # ax.legend(loc='best')
-            plt.xlabel('Iteration')
-            if map_labels:
-                c = lookup_label(c, mode=map_labels)
-            plt.ylabel(c)
-            fig.savefig(os.path.join(chkpt_dir, c + '.pdf'), bbox_inches='tight')
-            plt.close(fig)
+    # Group the columns into plots of single columns and of multi series (columns ending in _<number>)
+    plots = []
+    series = {}
+    for c in columns:
+        parts = c.split('_')
+        if parts[-1].isdigit():
+            key = tuple(parts[:-1])
+            if key not in series:
+                plots.append((''.join(key), series.setdefault(key, [])))
+            series[key].append(c)
+        else:
+            plots.append((c, None))
+
+    # Plot each of the columns including moving average into the same, cleared figure
+    fig = plt.figure(figsize=figsize)
+    for c, cis in plots:
+        label = lookup_label(c, mode=map_labels) if map_labels else c
+        # Skip plots that are up to date with the stats
+        pdf_file = os.path.join(chkpt_dir, label + '.pdf')
+        if not force and os.path.exists(pdf_file) and os.path.getmtime(pdf_file) >= stats_mtime:
+            continue
+        fig.clf()
+        ax = fig.add_subplot(1, 1, 1)
+        if cis is not None:
+            # Loop over them and plot into same plot
+            for ci in sorted(cis):
+                stats[ci].plot(ax=ax, linestyle='None', marker='.', alpha=0.2, label='_nolegend_')
+            ax.set_prop_cycle(None)
+            for ci in sorted(cis):
+                stats[ci + '_ma'].plot(ax=ax, linestyle='-', label=ci)
+            box = ax.get_position()
+            ax.set_position([box.x0, box.y0, box.width * 0.8, box.height])
+            ax.legend(loc='center left', bbox_to_anchor=(1, 0.5))
+        else:
+            stats[c].plot(ax=ax, alpha=0.2, linestyle='None', marker='.', label='_nolegend_')
+            ax.set_prop_cycle(None)
+            stats[c + '_ma'].plot(ax=ax, linestyle='-', label='_nolegend_')
+            # ax.legend(loc='best')
+        ax.set_xlabel('Iteration')
+        ax.set_ylabel(label)
+        fig.savefig(pdf_file, bbox_inches='tight')
+    plt.close(fig)
@@ -1,7 +1,6 @@
 import sys
 import os
 import time
-import IPython
 
 
 class ProgressBar(object):
@@ -25,10 +24,17 @@ class ProgressBar(object):
         self.ws = wait_symbol
         self.initial_x = initial_progress
         self.keep_after_done = keep_after_done
+        # Constant parts of the printed string, full runs of symbols to slice the bar from and the last drawn state
+        self._head = self.title + "["
+        self._tail = chr(8) * self._b
+        self._done_run = self.ds * self._w
+        self._wait_run = self.ws * self._w
+        self._drawn = None
 
     def start(self):
         """Creates a progress bar `width` chars long on the console
         and moves cursor back to beginning with BS character"""
+        self._drawn = None
         self.progress(self.initial_x)
 
     def progress(self, x):
@@ -37,8 +43,13 @@ class ProgressBar(object):
         assert x <= 1 or self.end_value is not None and self.end_value >= x
         if self.end_value is not None:
             x = x / self.end_value
-        y = int(x * self._w)                      
-        sys.stdout.write(self.title + "[" + self.ds * y + self.ws * (self._w - y) + "] {:3d}%".format(int(round(x * 100))) + chr(8) * self._b)
+        y = int(x * self._w)
+        percentage = int(round(x * 100))
+        # Only redraw when the visible bar or percentage changes
+        if (y, percentage) == self._drawn:
+            return
+        self._drawn = (y, percentage)
+        sys.stdout.write(f"{self._head}{self._done_run[:y]}{self._wait_run[y:]}] {percentage:3d}%{self._tail}")
         sys.stdout.flush()
 
     def end(self):
@@ -46,9 +57,9 @@ class ProgressBar(object):
         Write full bar, then move to next line except if `keep_after_done` is false
         in which case the bar is replaced by spaces and the cursor reset."""
         if self.keep_after_done:
-            s = self.title + "[" + self.ds * self._w + "] {:3d}%".format(100) + "\n"
+            s = f"{self._head}{self._done_run}] {100:3d}%\n"
         else:
-            s = ' ' * self._b  + chr(8) * self._b
+            s = ' ' * self._b + self._tail
         sys.stdout.write(s)
         sys.stdout.flush()
 
@@ -76,9 +87,10 @@ class PoolProgress(object):
         n_tasks = task._number_left*task._chunksize
         self.pb.end_value = n_tasks
         self.pb.start()
-        while task._number_left>0:
+        # Waiting on the job wakes up as soon as it completes instead of sleeping the full interval
+        while not job.ready():
             self.pb.progress(n_tasks - task._number_left*task._chunksize)
-            time.sleep(self.update_interval)
+            job.wait(self.update_interval)
         self.pb.end()
 
 
@@ -148,5 +160,6 @@ if __name__ == '__main__':
     print("Now we are done!")
 
 
+    import IPython
     IPython.embed()
     
\ No newline at end of file
@@ -1,13 +1,10 @@
 import math
 from collections import OrderedDict
 
-import IPython
 import numpy as np
-import pandas as pd
 import torch
 from torchvision.datasets import MNIST, FashionMNIST, CIFAR10, CIFAR100
 from torch import nn
-from torch.autograd import Variable
 
 
 def get_names_dict(model):
@@ -133,14 +130,12 @@ def summarize_model(model, input_size, return_meta=False):
         model.eval()
     # Names are stored in parent and path+name is unique not the name
     names = get_names_dict(model)
-    # Check if there are multiple inputs to the network
+    # Check if there are multiple inputs to the network and create them on the device of the model
+    device = next(model.parameters()).device
     if isinstance(input_size[0], (list, tuple)):
-        x = [Variable(torch.rand(1, *in_size)) for in_size in input_size]
+        x = [torch.rand(1, *in_size, device=device) for in_size in input_size]
     else:
-        x = Variable(torch.rand(1, *input_size))
-    # Move parameters to CUDA if relevant
-    if next(model.parameters()).is_cuda:
-        x = x.cuda()
+        x = torch.rand(1, *input_size, device=device)
     # Create properties
     summary = OrderedDict()
     hooks = []
@@ -157,6 +152,7 @@ def summarize_model(model, input_size, return_meta=False):
     if was_training:
         model.train()
     # Make dataframe
+    import pandas as pd
     df_summary = pd.DataFrame.from_dict(summary, orient='index')
     # Create additional info
     if return_meta:
@@ -170,6 +166,110 @@ def summarize_model(model, input_size, return_meta=False):
         return df_summary
 
 
+def preload_image_dataset(dataset):
+    """Loads all examples of a torchvision image dataset into a single tensor.
+
+    The images are kept as raw bytes which take up a quarter of the memory of floats and are
+    normalized batch-wise by `NormalizeImages` when loaded. The tensors are kept on the CPU in
+    shared memory so that the evaluation workers read them without copying.
+
+    Parameters:
+    ----------
+    dataset : {torchvision.datasets}
+        The dataset without transforms. Its `data` holds the raw images as (N, H, W) or (N, H, W, C) uint8 values.
+
+    Returns
+    -------
+    torch.utils.data.TensorDataset
+        The images as a uint8 tensor of shape (N, C, H, W) and the targets as a long tensor.
+    """
+    data = torch.as_tensor(dataset.data)
+    data = data.unsqueeze(1) if data.dim() == 3 else data.permute(0, 3, 1, 2).contiguous()
+    targets = torch.as_tensor(dataset.targets, dtype=torch.long)
+    data.share_memory_()
+    targets.share_memory_()
+    return torch.utils.data.TensorDataset(data, targets)
+
+
+class NormalizeImages(object):
+    """Converts a batch of uint8 images to floats in [0, 1] and normalizes each channel.
+
+    Equivalent to `transforms.Compose([transforms.ToTensor(), transforms.Normalize(mean, std)])` applied
+    to each image, but computed once for the whole batch on the device the batch is on.
+
+    Parameters:
+    ----------
+    mean : {tuple}
+        Mean of each channel
+    std : {tuple}
+        Standard deviation of each channel
+    channels_last : {bool}
+        Whether or not to return the images in channels last memory format (the default is False)
+    """
+    def __init__(self, mean, std, channels_last=False):
+        self.memory_format = torch.channels_last if channels_last else torch.contiguous_format
+        mean = torch.tensor(mean).view(1, -1, 1, 1)
+        std = torch.tensor(std).view(1, -1, 1, 1)
+        # Fold the conversion to [0, 1] into the normalization constants
+        self.scale = 1 / (255 * std)
+        self.offset = - mean / std
+
+    def __call__(self, batch):
+        data, target = batch
+        data = torch.addcmul(self.offset.to(data.device), data.float(), self.scale.to(data.device))
+        return [data.contiguous(memory_format=self.memory_format), target]
+
+
+class TensorDataLoader(object):
+    """Loads batches from a `TensorDataset` by indexing its tensors directly.
+
+    Replaces a `torch.utils.data.DataLoader` for datasets that fit in memory. Batches are gathered
+    with a single index operation per tensor instead of collating individually fetched examples.
+
+    Parameters:
+    ----------
+    dataset : {torch.utils.data.TensorDataset}
+        The dataset
+    batch_size : {int}
+        Number of examples in each batch
+    shuffle : {bool}
+        Whether or not to sample the examples in a new random order on each iteration
+    pin_memory : {bool}
+        Whether or not to gather batches in page-locked memory for asynchronous copies to the GPU
+    device : {torch.device}
+        Device to copy the batches to before applying `collate_fn` (the default is None which keeps them on the CPU).
+        The dataset itself stays on the CPU. Loaders sent to the CPU evaluation workers should not set a GPU device.
+    collate_fn : {callable}
+        Function applied to the list of batch tensors, e.g. to normalize them (the default is None)
+    name : {str}
+        Name of the dataset
+    """
+    def __init__(self, dataset, batch_size=1, shuffle=False, pin_memory=False, device=None, collate_fn=None, name=None):
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.pin_memory = pin_memory
+        self.device = device
+        self.collate_fn = collate_fn
+        self.name = name
+
+    def __iter__(self):
+        n = len(self.dataset)
+        indices = torch.randperm(n) if self.shuffle else torch.arange(n)
+        for batch_indices in indices.split(self.batch_size):
+            batch = [t.index_select(0, batch_indices) for t in self.dataset.tensors]
+            if self.pin_memory:
+                batch = [t.pin_memory() for t in batch]
+            if self.device is not None:
+                batch = [t.to(self.device, non_blocking=self.pin_memory) for t in batch]
+            if self.collate_fn is not None:
+                batch = self.collate_fn(batch)
+            yield batch
+
+    def __len__(self):
+        return math.ceil(len(self.dataset) / self.batch_size)
+
+
 def dataset_mean_and_var(dataset):
     """Compute the mean and standard deviation of a torchvision dataset
 